@@ -0,0 +1,78 @@
+""" Batch conversion of a directory of labelmaps to segmentations or surfaces.
+
+Runs without the Slicer application, for example on cluster nodes:
+
+  python -m SegmentEditorAidenLib.BatchConvert <input directory> <output directory> [--format seg|surface]
+
+(use PythonSlicer instead of python for surface output, which needs vtk). SegmentEditorAidenLib is a
+package of the module directory: run the command from that directory, or add it to PYTHONPATH.
+Files are converted in a process pool with one worker per core by default. The Slicer application
+runs this command as a PythonSlicer subprocess (SegmentEditorAidenLogic.convertDirectory) instead of
+starting the pool itself, which would fork the multi-threaded application process.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import concurrent.futures
+from .Conversion import convertLabelmapFile
+
+def findLabelmapFiles(inputDirectory):
+  """ Labelmap NRRD files of a directory, segmentation files excluded """
+  fileNames = sorted(os.listdir(inputDirectory))
+  return [os.path.join(inputDirectory, fileName) for fileName in fileNames
+    if fileName.lower().endswith(('.nrrd', '.nhdr')) and not fileName.lower().endswith('.seg.nrrd')]
+
+def convertDirectory(inputDirectory, outputDirectory, outputFormat='seg', workers=None, **options):
+  """ Convert all labelmaps of inputDirectory in a process pool.
+  Returns (results, failures): summaries of convertLabelmapFile and (input path, error) pairs.
+  """
+  inputPaths = findLabelmapFiles(inputDirectory)
+  if not os.path.isdir(outputDirectory):
+    os.makedirs(outputDirectory)
+  results = []
+  failures = []
+  startTime = time.time()
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+    futures = dict((executor.submit(convertLabelmapFile, inputPath, outputDirectory, outputFormat, **options), inputPath)
+      for inputPath in inputPaths)
+    for future in concurrent.futures.as_completed(futures):
+      inputPath = futures[future]
+      try:
+        result = future.result()
+      except Exception as e:
+        logging.error('Failed to convert {0}: {1}'.format(inputPath, e))
+        failures.append((inputPath, str(e)))
+        continue
+      logging.info('{0}: {1} segments in {2:.2f} s -> {3}'.format(
+        os.path.basename(inputPath), result['segments'], result['seconds'], result['output']))
+      results.append(result)
+  logging.info('Converted {0} of {1} labelmaps in {2:.2f} s'.format(len(results), len(inputPaths), time.time() - startTime))
+  return results, failures
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Convert a directory of labelmap NRRD files to segmentations or surfaces.')
+  parser.add_argument('inputDirectory')
+  parser.add_argument('outputDirectory')
+  parser.add_argument('--format', dest='outputFormat', choices=['seg', 'surface'], default='seg',
+    help='seg: one .seg.nrrd per labelmap, surface: one directory of .vtp surfaces per labelmap')
+  parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per core)')
+  parser.add_argument('--keep-background', action='store_true', help='also create a segment for label value 0, in a second labelmap layer')
+  parser.add_argument('--compression-level', type=int, default=6, help='gzip level of .seg.nrrd output, 0 for raw')
+  parser.add_argument('--smoothing', type=float, default=0.5, help='surface smoothing factor')
+  parser.add_argument('--decimation', type=float, default=0.0, help='surface decimation factor')
+  parser.add_argument('--summary', help='JSON file of the results and failures of the conversion')
+  args = parser.parse_args(argv)
+  logging.basicConfig(level=logging.INFO, format='%(message)s')
+  results, failures = convertDirectory(args.inputDirectory, args.outputDirectory, args.outputFormat, args.workers,
+    skipBackground=not args.keep_background, compressionLevel=args.compression_level,
+    smoothingFactor=args.smoothing, decimationFactor=args.decimation)
+  if args.summary:
+    with open(args.summary, 'w') as summaryFile:
+      json.dump({'results': results, 'failures': failures}, summaryFile, indent=2)
+  return 1 if failures else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,333 @@
+""" Benchmark and regression suite of the labelmap import, statistics, export and surface paths.
+
+Synthetic labelmaps of several sizes, label counts and fill fractions are converted stage by stage,
+and the time and resident memory growth of each stage are saved as JSON so that runs can be compared:
+
+  python -m SegmentEditorAidenLib.Benchmark <output.json> [--sizes 64 128 256 512] [--labels 4 64]
+    [--fill 0.05 0.4] [--no-surfaces] [--baseline <previous output.json>]
+
+SegmentEditorAidenLib is a package of the module directory: run the command from that directory, or
+add it to PYTHONPATH. Without Slicer, segments are kept by MemorySegmentStore and go through the same
+SegmentEditorAidenLib.SegmentStages functions as the module logic, which runs them on a segmentation
+node. Inside Slicer, SegmentEditorAiden.SegmentEditorAidenBenchmarkBackend runs the same cases through
+the module logic and the scene. Memory is measured as process resident memory (which includes VTK
+and other native allocations, unlike tracemalloc), so stages are timed without tracing overhead.
+With --baseline, stages slower or larger than the baseline beyond the tolerance are reported and the
+exit code is 1.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import collections
+import numpy
+from .LabelIndex import LabelIndex
+from .LabelmapExport import writeLabelmapFile
+from .SurfaceGeneration import cropToNonzero, surfaceArraysFromMask
+from .SegmentStages import (geometryKey, planLabelIndexImport, applyLabelIndexImport, segmentStatistics,
+  labelArrayFromStore)
+
+def syntheticLabelmap(size, labelCount, fillFraction, seed=0):
+  """ uint8/uint16 KJI labelmap of size^3 voxels with labelCount spheres of random centers filling about
+  fillFraction of the volume (later labels overwrite earlier ones where spheres overlap)
+  """
+  random = numpy.random.RandomState(seed)
+  labelArray = numpy.zeros((size, size, size), dtype=numpy.uint8 if labelCount < 256 else numpy.uint16)
+  radius = max((fillFraction * size ** 3 * 3.0 / (4.0 * numpy.pi * labelCount)) ** (1.0 / 3.0), 1.0)
+  for labelValue in range(1, labelCount + 1):
+    center = random.uniform(0, size, 3)
+    # bounding box of the sphere, clipped to the volume
+    first = numpy.maximum(numpy.floor(center - radius), 0).astype(int)
+    last = numpy.minimum(numpy.ceil(center + radius), size - 1).astype(int)
+    k, j, i = numpy.ogrid[first[0]:last[0] + 1, first[1]:last[1] + 1, first[2]:last[2] + 1]
+    inside = (k - center[0]) ** 2 + (j - center[1]) ** 2 + (i - center[2]) ** 2 <= radius ** 2
+    labelArray[first[0]:last[0] + 1, first[1]:last[1] + 1, first[2]:last[2] + 1][inside] = labelValue
+  return labelArray
+
+def syntheticIjkToRas(spacing=0.5):
+  """ LPS-like IJK to RAS array with isotropic spacing """
+  return numpy.diag([-spacing, -spacing, spacing, 1.0])
+
+class MemorySegmentStore(object):
+  """ Segment store of SegmentStages keeping the segments in memory: masks are copied in as
+  SetBinaryLabelmapToSegment does, and cropped to their voxels when read as getSegmentMask does
+  """
+  def __init__(self, shape, ijkToRas):
+    self.shape = shape
+    self.ijkToRas = ijkToRas
+    # segment ID -> dict of name, mask, extent, labelValue, contentHash
+    self.segments = collections.OrderedDict()
+    self.segmentCount = 0
+
+  def segmentIds(self):
+    return list(self.segments)
+
+  def addSegment(self, name):
+    self.segmentCount += 1
+    segmentId = 'Segment_{0}'.format(self.segmentCount)
+    self.segments[segmentId] = dict(name=name, mask=None, extent=None, labelValue=None, contentHash=None)
+    return segmentId
+
+  def removeSegment(self, segmentId):
+    del self.segments[segmentId]
+
+  def setMask(self, segmentId, mask, extent):
+    self.segments[segmentId]['mask'] = numpy.array(mask, dtype=numpy.uint8)
+    self.segments[segmentId]['extent'] = extent
+
+  def getMask(self, segmentId):
+    segment = self.segments[segmentId]
+    if segment['mask'] is None:
+      return None, None
+    mask, extent = cropToNonzero(segment['mask'] > 0, segment['extent'])
+    if mask is None:
+      return None, None
+    return mask.astype(numpy.uint8), extent
+
+  def importedSegments(self):
+    return dict((segment['labelValue'], (segmentId, segment['contentHash']))
+      for segmentId, segment in self.segments.items() if segment['labelValue'] is not None)
+
+  def setImportedLabel(self, segmentId, labelValue, contentHash, extent):
+    self.segments[segmentId]['labelValue'] = labelValue
+    self.segments[segmentId]['contentHash'] = contentHash
+
+  def labelValue(self, segmentId):
+    return self.segments[segmentId]['labelValue']
+
+class HeadlessBackend(object):
+  """ Benchmark stages through SegmentStages on a MemorySegmentStore, no Slicer needed """
+  name = 'headless'
+
+  def __init__(self, cropMargin=1, compressionLevel=1):
+    self.cropMargin = cropMargin
+    self.compressionLevel = compressionLevel
+    self.labelArray = None
+    self.store = None
+
+  def importLabelmap(self, labelArray, ijkToRas):
+    """ Returns the number of segments """
+    self.labelArray = labelArray
+    labelIndex = LabelIndex.fromArray(labelArray)
+    self.store = MemorySegmentStore(labelArray.shape, ijkToRas)
+    plan, contentHashes = planLabelIndexImport(self.store, labelIndex, geometryKey(ijkToRas), skipBackground=True)
+    applyLabelIndexImport(self.store, labelIndex, plan, contentHashes, cropMargin=self.cropMargin)
+    return len(self.store.segmentIds())
+
+  def computeStatistics(self):
+    """ Returns the number of statistics rows """
+    # the labelmap is its own gray image, so that the intensity reductions are timed too
+    statistics, segmentLabelValues = segmentStatistics(self.store, grayArray=self.labelArray)
+    return len(statistics['LabelValue'])
+
+  def exportLabelmap(self, filePath):
+    """ Returns the file size """
+    labelArray, segmentLabelValues, overlapCount = labelArrayFromStore(self.store)
+    return writeLabelmapFile(filePath, labelArray, self.store.ijkToRas, self.compressionLevel)['fileBytes']
+
+  def buildSurfaces(self):
+    """ Returns the number of surfaces """
+    segmentIds = self.store.segmentIds()
+    for segmentId in segmentIds:
+      mask, extent = self.store.getMask(segmentId)
+      surfaceArraysFromMask(mask, extent, self.store.ijkToRas)
+    return len(segmentIds)
+
+  def clear(self):
+    self.labelArray = None
+    self.store = None
+
+def _maxRssBytes():
+  """ Peak resident memory of the process so far, None where it is not available """
+  try:
+    import resource
+  except ImportError:
+    return None
+  maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # kilobytes on Linux, bytes on macOS
+  return maxRss if sys.platform == 'darwin' else maxRss * 1024
+
+def _rssBytes():
+  """ Current resident memory of the process, None where it is not available (read on Linux only) """
+  try:
+    with open('/proc/self/statm') as statmFile:
+      return int(statmFile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (IOError, OSError, ValueError, AttributeError):
+    return None
+
+def _difference(after, before):
+  return None if after is None or before is None else after - before
+
+def _peakRssBytes():
+  """ Peak resident memory of the process since the last _resetPeakRss (VmHWM), None where it is not available """
+  try:
+    with open('/proc/self/status') as statusFile:
+      for line in statusFile:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) * 1024
+  except (IOError, OSError, ValueError):
+    pass
+  return None
+
+def _resetPeakRss():
+  """ Reset the peak resident memory of the process to its current value, False where it cannot be (Linux only) """
+  try:
+    with open('/proc/self/clear_refs', 'w') as clearRefsFile:
+      clearRefsFile.write('5')
+  except (IOError, OSError):
+    return False
+  return True
+
+class _RssSampler(threading.Thread):
+  """ Largest resident memory sampled every interval seconds, where the process peak cannot be reset """
+  def __init__(self, interval=0.005):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.interval = interval
+    self.peakBytes = _rssBytes()
+    self.stopEvent = threading.Event()
+
+  def run(self):
+    while not self.stopEvent.wait(self.interval):
+      self.peakBytes = max(self.peakBytes, _rssBytes())
+
+  def stop(self):
+    """ Stop sampling, returns the peak """
+    self.stopEvent.set()
+    self.join()
+    return max(self.peakBytes, _rssBytes())
+
+def _runStage(function, *args):
+  """ (result, seconds, resident memory growth, peak resident memory growth) of one stage.
+  Memory is that of the whole process, so allocations of VTK and other native libraries are included.
+  The peak is measured from a reset of the process peak before the stage, or, where it cannot be
+  reset, by sampling the resident memory during the stage (short peaks may be missed).
+  """
+  rssBefore = _rssBytes()
+  sampler = None
+  if rssBefore is not None and not _resetPeakRss():
+    sampler = _RssSampler()
+    sampler.start()
+  startTime = time.time()
+  try:
+    result = function(*args)
+    seconds = time.time() - startTime
+  finally:
+    peakBytes = sampler.stop() if sampler else _peakRssBytes()
+  return result, seconds, _difference(_rssBytes(), rssBefore), _difference(peakBytes, rssBefore)
+
+def _megabytes(byteCount):
+  return 'n/a' if byteCount is None else '{0:+.1f}'.format(byteCount / 1.0e6)
+
+def benchmarkCase(backend, size, labelCount, fillFraction, outputDirectory, surfaces=True, seed=0):
+  """ Run the stages of one synthetic labelmap, returns the case result """
+  labelArray = syntheticLabelmap(size, labelCount, fillFraction, seed)
+  case = collections.OrderedDict()
+  case['backend'] = backend.name
+  case['size'] = size
+  case['labels'] = labelCount
+  case['fill'] = fillFraction
+  case['labeledVoxels'] = int(numpy.count_nonzero(labelArray))
+  stages = collections.OrderedDict()
+  filePath = os.path.join(outputDirectory, 'benchmark_{0}_{1}_{2}.nrrd'.format(size, labelCount, fillFraction))
+  calls = [('import', backend.importLabelmap, (labelArray, syntheticIjkToRas())),
+    ('statistics', backend.computeStatistics, ()),
+    ('export', backend.exportLabelmap, (filePath,))]
+  if surfaces:
+    calls.append(('surfaces', backend.buildSurfaces, ()))
+  try:
+    for stage, function, args in calls:
+      result, seconds, rssDeltaBytes, peakRssDeltaBytes = _runStage(function, *args)
+      stages[stage] = collections.OrderedDict([('seconds', seconds), ('rssDeltaBytes', rssDeltaBytes),
+        ('peakRssDeltaBytes', peakRssDeltaBytes), ('result', result)])
+      logging.info('{0}^3, {1} labels, fill {2}: {3} {4:.3f} s, resident memory {5} MB, peak {6} MB'.format(
+        size, labelCount, fillFraction, stage, seconds, _megabytes(rssDeltaBytes), _megabytes(peakRssDeltaBytes)))
+  finally:
+    backend.clear()
+    if os.path.exists(filePath):
+      os.remove(filePath)
+  case['stages'] = stages
+  case['maxRssBytes'] = _maxRssBytes()
+  return case
+
+def runBenchmark(sizes=(64, 128, 256, 512), labelCounts=(4, 64), fillFractions=(0.05, 0.4), backend=None,
+    surfaces=True, outputPath=None):
+  """ Benchmark every combination of sizes, label counts and fill fractions with backend (default:
+  HeadlessBackend). Returns the results, also written as JSON to outputPath if given.
+  """
+  backend = backend or HeadlessBackend()
+  results = collections.OrderedDict()
+  results['created'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+  results['platform'] = collections.OrderedDict([('python', platform.python_version()),
+    ('numpy', numpy.__version__), ('machine', platform.machine()), ('cpus', os.cpu_count())])
+  results['backend'] = backend.name
+  results['cases'] = []
+  workDirectory = tempfile.mkdtemp(prefix='SegmentEditorAidenBenchmark')
+  try:
+    for size in sizes:
+      for labelCount in labelCounts:
+        for fillFraction in fillFractions:
+          results['cases'].append(benchmarkCase(backend, size, labelCount, fillFraction, workDirectory, surfaces))
+  finally:
+    shutil.rmtree(workDirectory, ignore_errors=True)
+  if outputPath:
+    with open(outputPath, 'w') as outputFile:
+      json.dump(results, outputFile, indent=2)
+  return results
+
+def compareResults(baseline, current, tolerance=0.25, minSeconds=0.05, minBytes=16*1024*1024):
+  """ Stages of current that are slower, or raise the peak resident memory more, than the same case of
+  baseline by more than tolerance (relative). Differences under minSeconds and minBytes are ignored as
+  noise, and so are memory measures missing from either run.
+  Returns a list of (case key, stage, measure, baseline value, current value).
+  """
+  caseKey = lambda case: (case['backend'], case['size'], case['labels'], case['fill'])
+  baselineCases = dict((caseKey(case), case) for case in baseline['cases'])
+  regressions = []
+  for case in current['cases']:
+    baselineCase = baselineCases.get(caseKey(case))
+    if baselineCase is None:
+      continue
+    for stage, measures in case['stages'].items():
+      baselineMeasures = baselineCase['stages'].get(stage)
+      if baselineMeasures is None:
+        continue
+      seconds, baselineSeconds = measures['seconds'], baselineMeasures['seconds']
+      if seconds > baselineSeconds * (1 + tolerance) and seconds - baselineSeconds > minSeconds:
+        regressions.append((caseKey(case), stage, 'seconds', baselineSeconds, seconds))
+      peakBytes, baselinePeakBytes = measures.get('peakRssDeltaBytes'), baselineMeasures.get('peakRssDeltaBytes')
+      if peakBytes is None or baselinePeakBytes is None:
+        continue
+      if peakBytes > baselinePeakBytes * (1 + tolerance) and peakBytes - baselinePeakBytes > minBytes:
+        regressions.append((caseKey(case), stage, 'peakRssDeltaBytes', baselinePeakBytes, peakBytes))
+  return regressions
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark labelmap import, statistics, export and surfaces on synthetic labelmaps.')
+  parser.add_argument('outputPath', help='JSON file of the results')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[64, 128, 256, 512], help='labelmap sizes (voxels per side)')
+  parser.add_argument('--labels', type=int, nargs='+', default=[4, 64], help='label counts')
+  parser.add_argument('--fill', type=float, nargs='+', default=[0.05, 0.4], help='fractions of labeled voxels')
+  parser.add_argument('--no-surfaces', action='store_true', help='skip surface generation (which needs vtk)')
+  parser.add_argument('--baseline', help='JSON results of an earlier run to check for regressions')
+  parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown or memory growth reported as regression')
+  args = parser.parse_args(argv)
+  logging.basicConfig(level=logging.INFO, format='%(message)s')
+  results = runBenchmark(args.sizes, args.labels, args.fill, surfaces=not args.no_surfaces, outputPath=args.outputPath)
+  if not args.baseline:
+    return 0
+  with open(args.baseline) as baselineFile:
+    baseline = json.load(baselineFile)
+  regressions = compareResults(baseline, results, args.tolerance)
+  for key, stage, measure, baselineValue, value in regressions:
+    logging.warning('Regression {0} {1} {2}: {3:.3g} -> {4:.3g}'.format(key, stage, measure, baselineValue, value))
+  return 1 if regressions else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
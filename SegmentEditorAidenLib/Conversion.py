@@ -0,0 +1,120 @@
+import os
+import time
+import colorsys
+import collections
+import numpy
+from .LabelIndex import LabelIndex
+from .NrrdIO import readNrrd, writeNrrd, ijkToRasFromNrrdHeader, spaceFieldsFromIjkToRas
+from .SurfaceGeneration import surfaceArraysFromMask, polyDataFromSurfaceArrays
+
+#
+# Labelmap -> segmentation conversion without a Slicer scene
+#
+# Used by the batch conversion command line (BatchConvert) and by worker processes, so it only
+# depends on numpy (and vtk for surface output).
+#
+
+# Same segment tag as SegmentEditorAiden.LABEL_VALUE_TAG
+LABEL_VALUE_TAG = 'SegmentEditorAiden.LabelValue'
+
+def segmentNameForLabel(labelValue):
+  return 'Temp_' + str(labelValue)
+
+def labelColor(labelValue):
+  """ Distinct, reproducible RGB color of a label value (golden ratio hue steps) """
+  hue = (labelValue * 0.618033988749895) % 1.0
+  return colorsys.hsv_to_rgb(hue, 0.65, 0.95)
+
+def smallestLabelType(labelArray):
+  """ Smallest unsigned integer type holding all label values, the array type if values are negative """
+  if labelArray.size and labelArray.min() < 0:
+    return labelArray.dtype
+  maximum = int(labelArray.max()) if labelArray.size else 0
+  for dtype in (numpy.uint8, numpy.uint16, numpy.uint32):
+    if maximum <= numpy.iinfo(dtype).max:
+      return numpy.dtype(dtype)
+  return numpy.dtype(numpy.uint64)
+
+def writeSegmentationFile(filePath, labelArray, ijkToRas, labelIndex, labelValues, compressionLevel=6):
+  """ Write label values of a KJI label array as a .seg.nrrd segmentation.
+  Labels do not overlap, so all segments share one labelmap layer that keeps the original label values.
+  Label value 0 is empty in that layer: its segment, if requested, is value 1 of a second layer.
+  """
+  layer = labelArray
+  keptValues = set(labelValues)
+  droppedValues = [value for value in labelIndex.labelValues() if value not in keptValues and value != 0]
+  if droppedValues:
+    layer = numpy.where(numpy.isin(labelArray, droppedValues), 0, labelArray)
+  layer = layer.astype(smallestLabelType(layer), copy=False)
+  if 0 in keptValues:
+    # layers are the fastest axis of a multi-layer segmentation
+    layer = numpy.stack([layer, (labelArray == 0).astype(layer.dtype)], axis=-1)
+
+  keyValues = collections.OrderedDict()
+  keyValues['Segmentation_MasterRepresentation'] = 'Binary labelmap'
+  keyValues['Segmentation_ContainedRepresentationNames'] = 'Binary labelmap|'
+  keyValues['Segmentation_ReferenceImageExtentOffset'] = '0 0 0'
+  for segmentIndex, labelValue in enumerate(labelValues):
+    prefix = 'Segment{0}_'.format(segmentIndex)
+    keyValues[prefix + 'ID'] = 'Segment_{0}'.format(labelValue)
+    keyValues[prefix + 'Name'] = segmentNameForLabel(labelValue)
+    keyValues[prefix + 'NameAutoGenerated'] = '0'
+    keyValues[prefix + 'Color'] = ' '.join('{0:.6g}'.format(c) for c in labelColor(labelValue))
+    keyValues[prefix + 'ColorAutoGenerated'] = '1'
+    keyValues[prefix + 'Extent'] = ' '.join(str(e) for e in labelIndex.extent(labelValue))
+    keyValues[prefix + 'Layer'] = '1' if labelValue == 0 else '0'
+    keyValues[prefix + 'LabelValue'] = '1' if labelValue == 0 else str(labelValue)
+    keyValues[prefix + 'Tags'] = '{0}:{1}|'.format(LABEL_VALUE_TAG, labelValue)
+
+  fields = spaceFieldsFromIjkToRas(ijkToRas)
+  fields['kinds'] = 'domain domain domain'
+  if layer.ndim == 4:
+    fields['space directions'] = 'none ' + fields['space directions']
+    fields['kinds'] = 'list domain domain domain'
+  writeNrrd(filePath, layer, fields, keyValues, compressionLevel)
+
+def writeSurfaceFiles(outputDirectory, labelIndex, ijkToRas, labelValues, smoothingFactor=0.5, decimationFactor=0.0):
+  """ Write the closed surface of each label value as <segment name>.vtp, returns the file paths """
+  import vtk
+  if not os.path.isdir(outputDirectory):
+    os.makedirs(outputDirectory)
+  filePaths = []
+  for labelValue in labelValues:
+    mask, extent = labelIndex.croppedMask(labelValue)
+    surfaceArrays = surfaceArraysFromMask(mask, extent, ijkToRas, smoothingFactor, decimationFactor)
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetInputData(polyDataFromSurfaceArrays(surfaceArrays))
+    filePath = os.path.join(outputDirectory, segmentNameForLabel(labelValue) + '.vtp')
+    writer.SetFileName(filePath)
+    writer.Write()
+    filePaths.append(filePath)
+  return filePaths
+
+def caseName(filePath):
+  """ File name without directory and NRRD extensions """
+  name = os.path.basename(filePath)
+  for extension in ('.seg.nrrd', '.nrrd', '.nhdr'):
+    if name.lower().endswith(extension):
+      return name[:-len(extension)]
+  return name
+
+def convertLabelmapFile(inputPath, outputDirectory, outputFormat='seg', skipBackground=True, compressionLevel=6,
+    smoothingFactor=0.5, decimationFactor=0.0):
+  """ Convert one labelmap NRRD file to <case>.seg.nrrd (outputFormat 'seg') or to a
+  <case>_surfaces directory of .vtp files (outputFormat 'surface').
+  Returns a summary dict, suitable for returning from worker processes.
+  """
+  startTime = time.time()
+  labelArray, header = readNrrd(inputPath)
+  ijkToRas = ijkToRasFromNrrdHeader(header)
+  labelIndex = LabelIndex.fromArray(labelArray)
+  labelValues = labelIndex.labelValues(skipBackground=skipBackground)
+  if outputFormat == 'seg':
+    outputPath = os.path.join(outputDirectory, caseName(inputPath) + '.seg.nrrd')
+    writeSegmentationFile(outputPath, labelArray, ijkToRas, labelIndex, labelValues, compressionLevel)
+  elif outputFormat == 'surface':
+    outputPath = os.path.join(outputDirectory, caseName(inputPath) + '_surfaces')
+    writeSurfaceFiles(outputPath, labelIndex, ijkToRas, labelValues, smoothingFactor, decimationFactor)
+  else:
+    raise ValueError('Unknown output format: {0}'.format(outputFormat))
+  return {'input': inputPath, 'output': outputPath, 'segments': len(labelValues), 'seconds': time.time() - startTime}
@@ -0,0 +1,37 @@
+#
+# Diff-based re-import of a labelmap into existing segments
+#
+# Imported segments remember their label value and content hash, so re-applying a labelmap
+# only adds, rewrites or removes the segments of labels that actually changed.
+#
+
+class LabelImportPlan(object):
+  """ Segment operations needed to bring imported segments in line with a labelmap """
+  def __init__(self):
+    self.added = []      # label values without a segment
+    self.changed = []    # (label value, segment ID) whose voxels differ
+    self.unchanged = []  # (label value, segment ID) that can be kept as is
+    self.removed = []    # segment IDs of label values no longer imported
+
+  def __str__(self):
+    return '{0} added, {1} changed, {2} unchanged, {3} removed'.format(
+      len(self.added), len(self.changed), len(self.unchanged), len(self.removed))
+
+def planLabelImport(existingSegments, contentHashes):
+  """ Compare imported segments with the label values of a new labelmap.
+  existingSegments maps label value -> (segment ID, content hash or None),
+  contentHashes maps each label value to import -> its content hash.
+  """
+  plan = LabelImportPlan()
+  for labelValue in sorted(contentHashes):
+    existing = existingSegments.get(labelValue)
+    if existing is None:
+      plan.added.append(labelValue)
+    elif existing[1] != contentHashes[labelValue]:
+      plan.changed.append((labelValue, existing[0]))
+    else:
+      plan.unchanged.append((labelValue, existing[0]))
+  for labelValue in sorted(existingSegments):
+    if labelValue not in contentHashes:
+      plan.removed.append(existingSegments[labelValue][0])
+  return plan
@@ -0,0 +1,102 @@
+import numpy
+from .SurfaceGeneration import cropToNonzero
+
+#
+# Single-pass multi-range thresholding
+#
+# The minima and maxima of all ranges cut the intensity axis into intervals. Every voxel is labeled
+# once with the index of its interval (a small integer, found by binary search over the few cuts),
+# and the slices holding each interval are recorded. A range is then a run of consecutive intervals:
+# its mask is two comparisons of the small labels, only over the slices that hold the range.
+# Overlapping ranges share intervals and work unchanged.
+#
+
+# (name, minimum, maximum, (r, g, b)) in Hounsfield units, ranges may overlap
+INTENSITY_RANGE_PRESETS = {
+  'Body composition': [
+    ('Air', -1024, -951, (0.2, 0.2, 0.2)),
+    ('Lung', -950, -500, (0.77, 0.69, 0.54)),
+    ('Fat', -190, -30, (0.9, 0.85, 0.3)),
+    ('Muscle', -29, 150, (0.75, 0.25, 0.2)),
+    ('Soft tissue', 20, 80, (0.95, 0.6, 0.55)),
+    ('Contrast-enhanced blood', 150, 300, (0.85, 0.1, 0.15)),
+    ('Trabecular bone', 150, 700, (0.95, 0.9, 0.75)),
+    ('Cortical bone', 700, 3071, (1.0, 1.0, 0.95)),
+    ],
+  'Tissue classes': [
+    ('Fat', -190, -30, (0.9, 0.85, 0.3)),
+    ('Soft tissue', -29, 150, (0.75, 0.25, 0.2)),
+    ('Bone', 151, 3071, (1.0, 1.0, 0.95)),
+    ],
+  }
+
+def rangeCuts(dtype, minimum, maximum):
+  """ (lower, upper) such that minimum <= value <= maximum is lower <= value < upper for values of dtype """
+  dtype = numpy.dtype(dtype)
+  if numpy.issubdtype(dtype, numpy.integer):
+    return float(numpy.ceil(minimum)), float(numpy.floor(maximum) + 1)
+  # bounds are compared in the array type, as array >= minimum does
+  upper = numpy.nextafter(dtype.type(maximum), dtype.type(numpy.inf))
+  return float(dtype.type(minimum)), float(upper)
+
+class IntensityIntervals(object):
+  """ Voxels of a grayscale array labeled by the interval between the cuts of intensity ranges,
+  for thresholding many ranges in one pass. The array is labeled in slabs of at most maxSlabVoxels
+  so that the binary search temporaries stay small.
+  """
+  def __init__(self, array, ranges, maxSlabVoxels=4*1024*1024):
+    self.shape = array.shape
+    self.dtype = array.dtype
+    cuts = set()
+    for intensityRange in ranges:
+      cuts.update(rangeCuts(array.dtype, intensityRange[1], intensityRange[2]))
+    self.cuts = numpy.array(sorted(cuts), dtype=numpy.float64)
+    intervalCount = len(self.cuts) + 1
+    self.intervals = numpy.empty(array.shape, dtype=numpy.uint8 if intervalCount <= 256 else numpy.uint16)
+    # intervals present in each K slice
+    nk, nj, ni = array.shape
+    self.sliceIntervals = numpy.zeros((nk, intervalCount), dtype=bool)
+    slabThickness = max(maxSlabVoxels // max(nj * ni, 1), 1)
+    for k0 in range(0, nk, slabThickness):
+      k1 = min(k0 + slabThickness, nk)
+      slab = numpy.searchsorted(self.cuts, array[k0:k1], side='right')
+      self.intervals[k0:k1] = slab
+      sliceOffsets = numpy.arange(k1 - k0).reshape(-1, 1, 1) * intervalCount
+      self.sliceIntervals[k0:k1] = numpy.bincount((slab + sliceOffsets).reshape(-1),
+        minlength=(k1 - k0) * intervalCount).reshape(k1 - k0, intervalCount) > 0
+
+  def intervalRange(self, minimum, maximum):
+    """ first and last + 1 interval of the voxels with minimum <= value <= maximum """
+    lower, upper = rangeCuts(self.dtype, minimum, maximum)
+    if lower >= upper:
+      return 0, 0
+    return int(numpy.searchsorted(self.cuts, lower)) + 1, int(numpy.searchsorted(self.cuts, upper)) + 1
+
+  def rangeMask(self, minimum, maximum, cropMargin=None):
+    """ uint8 mask of the voxels with minimum <= value <= maximum.
+    If cropMargin is not None the mask only covers the bounding box of the voxels grown by cropMargin.
+    Returns (mask, extent) with extent the inclusive IJK extent of the mask, (None, None) if there are no voxels.
+    """
+    nk, nj, ni = self.shape
+    first, last = self.intervalRange(minimum, maximum)
+    slices = numpy.flatnonzero(self.sliceIntervals[:, first:last].any(axis=1))
+    if cropMargin is None:
+      mask = numpy.zeros(self.shape, dtype=numpy.uint8)
+      if len(slices):
+        k0, k1 = slices[0], slices[-1] + 1
+        slab = self.intervals[k0:k1]
+        mask[k0:k1] = (slab >= first) & (slab < last)
+      return mask, (0, ni - 1, 0, nj - 1, 0, nk - 1)
+    if not len(slices):
+      return None, None
+    k0, k1 = max(slices[0] - cropMargin, 0), min(slices[-1] + cropMargin, nk - 1)
+    slab = self.intervals[k0:k1 + 1]
+    mask, extent = cropToNonzero((slab >= first) & (slab < last), (0, ni - 1, 0, nj - 1, k0, k1), cropMargin)
+    return mask.astype(numpy.uint8), tuple(int(e) for e in extent)
+
+def iterRangeMasks(array, ranges, cropMargin=None):
+  """ Yield (range, mask, extent) for each (name, minimum, maximum, ...) range, labeling the array once """
+  intervals = IntensityIntervals(array, ranges)
+  for intensityRange in ranges:
+    mask, extent = intervals.rangeMask(intensityRange[1], intensityRange[2], cropMargin)
+    yield intensityRange, mask, extent
@@ -0,0 +1,118 @@
+import hashlib
+import numpy
+from .LabelmapImport import LabelVoxelGroups
+
+#
+# Sparse label value index
+#
+# Records only the label values that are present in a labelmap, with their voxel count and
+# bounding box, so that absent values of sparse label codes (1, 2, 1000, ...) never become segments.
+#
+
+class LabelIndex(object):
+  """ Present label values of a labelmap with voxel counts and bounding boxes.
+  Bounding boxes are inclusive IJK extents (iMin, iMax, jMin, jMax, kMin, kMax), the convention
+  of vtkOrientedImageData, while label arrays are KJI-ordered as returned by arrayFromVolume.
+  """
+  def __init__(self, shape, values, counts, extents, groups=None):
+    self.shape = tuple(shape)
+    self.values = numpy.asarray(values)
+    self.counts = numpy.asarray(counts)
+    self.extents = numpy.asarray(extents, dtype=numpy.int64).reshape(-1, 6)
+    self.groups = groups
+    self._positions = dict((int(value), n) for n, value in enumerate(self.values))
+
+  @classmethod
+  def fromArray(cls, labelArray):
+    """ Build the index from a KJI label array in a single pass """
+    groups = LabelVoxelGroups(labelArray)
+    extents = numpy.zeros((len(groups.values), 6), dtype=numpy.int64)
+    if len(groups.values):
+      # Coordinates are derived one axis at a time from the grouped flat indices,
+      # then reduced per label group.
+      for axis, coordinates in groups.iterCoordinates():
+        extents[:, 2 * axis] = numpy.minimum.reduceat(coordinates, groups.starts)
+        extents[:, 2 * axis + 1] = numpy.maximum.reduceat(coordinates, groups.starts)
+        del coordinates
+    return cls(groups.shape, groups.values, groups.counts, extents, groups)
+
+  def __len__(self):
+    return len(self.values)
+
+  def __contains__(self, value):
+    return int(value) in self._positions
+
+  def labelValues(self, skipBackground=False, backgroundValue=0):
+    """ Present label values in increasing order """
+    return [int(value) for value in self.values if not (skipBackground and value == backgroundValue)]
+
+  def voxelCount(self, value):
+    n = self._positions.get(int(value))
+    return 0 if n is None else int(self.counts[n])
+
+  def extent(self, value):
+    n = self._positions.get(int(value))
+    return None if n is None else tuple(int(e) for e in self.extents[n])
+
+  def croppedExtent(self, value, margin=0):
+    """ Bounding box of a label value grown by margin voxels, clipped to the volume """
+    extent = self.extent(value)
+    if extent is None:
+      return None
+    nk, nj, ni = self.shape
+    maxima = (ni - 1, nj - 1, nk - 1)
+    cropped = []
+    for axis in range(3):
+      cropped.append(max(extent[2 * axis] - margin, 0))
+      cropped.append(min(extent[2 * axis + 1] + margin, maxima[axis]))
+    return tuple(cropped)
+
+  def mask(self, value):
+    """ full-size uint8 mask of one present label value """
+    self._checkGroups()
+    return self.groups.mask(value)
+
+  def croppedMask(self, value, margin=0):
+    """ uint8 mask of one present label value covering only its bounding box grown by margin.
+    Returns (mask, extent), mask[0, 0, 0] is voxel (extent[4], extent[2], extent[0]).
+    """
+    self._checkGroups()
+    extent = self.croppedExtent(value, margin)
+    if extent is None:
+      raise ValueError('Label value {0} is not present'.format(value))
+    i0, i1, j0, j1, k0, k1 = extent
+    mask = numpy.zeros((k1 - k0 + 1, j1 - j0 + 1, i1 - i0 + 1), dtype=numpy.uint8)
+    k, j, i = numpy.unravel_index(self.groups.flatIndices(value), self.shape)
+    mask[k - k0, j - j0, i - i0] = 1
+    return mask, extent
+
+  def contentHash(self, value, salt=''):
+    """ Hash of the voxels of one label value, used to detect which labels changed between imports.
+    salt can carry the volume geometry so that the same voxels in a moved volume hash differently.
+    """
+    self._checkGroups()
+    digest = hashlib.sha1()
+    digest.update(str(salt).encode('utf-8'))
+    digest.update(numpy.asarray(self.shape, dtype=numpy.int64).tobytes())
+    digest.update(numpy.ascontiguousarray(self.groups.flatIndices(value), dtype=numpy.int64).tobytes())
+    return digest.hexdigest()
+
+  def _checkGroups(self):
+    if self.groups is None:
+      raise ValueError('LabelIndex has no voxel groups, masks cannot be extracted')
+
+def splitLabelLayer(layerArray, extent, labelValues):
+  """ Cropped masks of several label values of one KJI labelmap layer with inclusive IJK extent, grouping the
+  layer voxels once instead of comparing the whole layer once per value.
+  Returns label value -> (uint8 mask, IJK extent), (None, None) for values without voxels.
+  """
+  labelIndex = LabelIndex.fromArray(layerArray)
+  i0, j0, k0 = extent[0], extent[2], extent[4]
+  masks = {}
+  for labelValue in labelValues:
+    if labelValue not in labelIndex:
+      masks[labelValue] = (None, None)
+      continue
+    mask, (mi0, mi1, mj0, mj1, mk0, mk1) = labelIndex.croppedMask(labelValue)
+    masks[labelValue] = (mask, (i0 + mi0, i0 + mi1, j0 + mj0, j0 + mj1, k0 + mk0, k0 + mk1))
+  return masks
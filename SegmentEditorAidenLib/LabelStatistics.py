@@ -0,0 +1,173 @@
+import collections
+import numpy
+from .LabelIndex import LabelIndex
+
+#
+# Per-label statistics in one pass
+#
+# The voxels are grouped by label once (LabelIndex sort); counts, centroids, bounding boxes and
+# grayscale mean/min/max/std of all labels are then grouped reductions (ufunc.reduceat) over the
+# sorted voxels, instead of one full-volume scan per segment. The reductions are kept as sums
+# (LabelSums) so that slabs of a volume too large for memory can be reduced one at a time and merged.
+# Segments may overlap, unlike labels: their sums are reduced from each segment's own cropped mask
+# (LabelSums.fromMasks), within the mask box only.
+#
+
+STATISTICS_COLUMNS = ['LabelValue', 'VoxelCount', 'Volume_mm3', 'Centroid_R', 'Centroid_A', 'Centroid_S',
+  'Extent_IMin', 'Extent_IMax', 'Extent_JMin', 'Extent_JMax', 'Extent_KMin', 'Extent_KMax']
+INTENSITY_COLUMNS = ['Mean', 'Min', 'Max', 'StdDev']
+
+class LabelSums(object):
+  """ Per-label voxel counts, IJK extents, IJK coordinate sums and, if a gray array was given,
+  intensity sums, sums of squares, minima and maxima. values are sorted (in mask order for fromMasks,
+  which cannot be merged), all arrays are indexed like them.
+  """
+  def __init__(self, values, counts, extents, coordinateSums, intensitySums=None):
+    self.values = numpy.asarray(values)
+    self.counts = numpy.asarray(counts, dtype=numpy.int64)
+    self.extents = numpy.asarray(extents, dtype=numpy.int64).reshape(-1, 6)
+    self.coordinateSums = numpy.asarray(coordinateSums, dtype=numpy.float64).reshape(-1, 3)
+    # columns: sum, sum of squares, minimum, maximum
+    self.intensitySums = None if intensitySums is None else numpy.asarray(intensitySums, dtype=numpy.float64).reshape(-1, 4)
+
+  @classmethod
+  def fromArray(cls, labelArray, grayArray=None, labelIndex=None, kOffset=0):
+    """ Sums of a KJI label array, or of a slab of a larger one starting at slice kOffset """
+    if labelIndex is None:
+      labelIndex = LabelIndex.fromArray(labelArray)
+    groups = labelIndex.groups
+    extents = labelIndex.extents.copy()
+    extents[:, 4:6] += kOffset
+    coordinateSums = numpy.zeros((len(labelIndex.values), 3))
+    intensitySums = None
+    if len(labelIndex.values):
+      for column, coordinates in groups.iterCoordinates():
+        # int32 coordinates would overflow when summed
+        coordinateSums[:, column] = numpy.add.reduceat(coordinates, groups.starts, dtype=numpy.int64)
+        del coordinates
+      coordinateSums[:, 2] += kOffset * labelIndex.counts
+    if grayArray is not None:
+      if grayArray.shape != labelArray.shape:
+        raise ValueError('Gray array shape {0} differs from label array shape {1}'.format(grayArray.shape, labelArray.shape))
+      intensitySums = numpy.zeros((len(labelIndex.values), 4))
+      if len(labelIndex.values):
+        sortedGray = numpy.ascontiguousarray(grayArray).reshape(-1)[groups.order].astype(numpy.float64)
+        intensitySums[:, 2] = numpy.minimum.reduceat(sortedGray, groups.starts)
+        intensitySums[:, 3] = numpy.maximum.reduceat(sortedGray, groups.starts)
+        intensitySums[:, 0] = numpy.add.reduceat(sortedGray, groups.starts)
+        numpy.square(sortedGray, out=sortedGray)
+        intensitySums[:, 1] = numpy.add.reduceat(sortedGray, groups.starts)
+    return cls(labelIndex.values, labelIndex.counts, extents, coordinateSums, intensitySums)
+
+  @classmethod
+  def fromMasks(cls, values, masks, shape, grayArray=None):
+    """ Sums of KJI masks, given as (mask, extent) with the inclusive IJK extent of each mask on the grid of
+    an array of the given shape, one row per value. Masks may overlap. Parts of a mask outside the array
+    are ignored, masks without voxels inside are left out.
+    """
+    if grayArray is not None and grayArray.shape != tuple(shape):
+      raise ValueError('Gray array shape {0} differs from label array shape {1}'.format(grayArray.shape, tuple(shape)))
+    rows = []
+    for value, (mask, extent) in zip(values, masks):
+      row = maskSums(mask, extent, shape, grayArray)
+      if row is not None:
+        rows.append((value,) + row)
+    rowValues = [row[0] for row in rows]
+    counts = [row[1] for row in rows]
+    extents = [row[2] for row in rows]
+    coordinateSums = [row[3] for row in rows]
+    intensitySums = None if grayArray is None else [row[4] for row in rows]
+    return cls(rowValues, counts, extents, coordinateSums, intensitySums)
+
+  def merge(self, other):
+    """ Sums over the voxels of both, e.g. of two slabs of the same volume """
+    values = numpy.union1d(self.values, other.values)
+    counts = numpy.zeros(len(values), dtype=numpy.int64)
+    extents = numpy.empty((len(values), 6), dtype=numpy.int64)
+    extents[:, 0::2] = numpy.iinfo(numpy.int64).max
+    extents[:, 1::2] = numpy.iinfo(numpy.int64).min
+    coordinateSums = numpy.zeros((len(values), 3))
+    hasIntensities = self.intensitySums is not None and other.intensitySums is not None
+    intensitySums = None
+    if hasIntensities:
+      intensitySums = numpy.zeros((len(values), 4))
+      intensitySums[:, 2] = numpy.inf
+      intensitySums[:, 3] = -numpy.inf
+    for sums in (self, other):
+      # values are unique within each, so fancy-indexed updates do not collide
+      rows = numpy.searchsorted(values, sums.values)
+      counts[rows] += sums.counts
+      extents[rows, 0::2] = numpy.minimum(extents[rows, 0::2], sums.extents[:, 0::2])
+      extents[rows, 1::2] = numpy.maximum(extents[rows, 1::2], sums.extents[:, 1::2])
+      coordinateSums[rows] += sums.coordinateSums
+      if hasIntensities:
+        intensitySums[rows, 0:2] += sums.intensitySums[:, 0:2]
+        intensitySums[rows, 2] = numpy.minimum(intensitySums[rows, 2], sums.intensitySums[:, 2])
+        intensitySums[rows, 3] = numpy.maximum(intensitySums[rows, 3], sums.intensitySums[:, 3])
+    return LabelSums(values, counts, extents, coordinateSums, intensitySums)
+
+  def statistics(self, ijkToRas, skipBackground=True):
+    """ Ordered dict of column name -> array, see computeLabelStatistics """
+    ijkToRas = numpy.asarray(ijkToRas, dtype=float)
+    counts = self.counts.astype(numpy.float64)
+    statistics = collections.OrderedDict()
+    statistics['LabelValue'] = self.values
+    statistics['VoxelCount'] = self.counts
+    statistics['Volume_mm3'] = counts * abs(numpy.linalg.det(ijkToRas[:3, :3]))
+    centroidsIjk = numpy.ones((len(counts), 4))
+    if len(counts):
+      centroidsIjk[:, :3] = self.coordinateSums / counts[:, numpy.newaxis]
+    centroidsRas = numpy.dot(centroidsIjk, ijkToRas.T)
+    for column, name in enumerate(['Centroid_R', 'Centroid_A', 'Centroid_S']):
+      statistics[name] = centroidsRas[:, column]
+    for column, name in enumerate(STATISTICS_COLUMNS[6:]):
+      statistics[name] = self.extents[:, column]
+    if self.intensitySums is not None:
+      means = self.intensitySums[:, 0] / counts if len(counts) else numpy.zeros(0)
+      variances = numpy.maximum(self.intensitySums[:, 1] / counts - means * means, 0.0) if len(counts) else numpy.zeros(0)
+      statistics['Mean'] = means
+      statistics['Min'] = self.intensitySums[:, 2]
+      statistics['Max'] = self.intensitySums[:, 3]
+      statistics['StdDev'] = numpy.sqrt(variances)
+    if skipBackground:
+      keep = self.values != 0
+      for name in statistics:
+        statistics[name] = statistics[name][keep]
+    return statistics
+
+def maskSums(mask, extent, shape, grayArray=None):
+  """ (voxel count, IJK extent, IJK coordinate sums, intensity sums) of a KJI mask with inclusive IJK extent,
+  reduced from per-axis voxel counts and the gray voxels of the mask box. Intensity sums are None without
+  grayArray. Returns None if no voxel of the mask is inside an array of the given shape.
+  """
+  nk, nj, ni = shape
+  i0, i1, j0, j1, k0, k1 = extent
+  ci0, ci1 = max(i0, 0), min(i1, ni - 1)
+  cj0, cj1 = max(j0, 0), min(j1, nj - 1)
+  ck0, ck1 = max(k0, 0), min(k1, nk - 1)
+  if ci0 > ci1 or cj0 > cj1 or ck0 > ck1:
+    return None
+  inside = mask[ck0 - k0:ck1 - k0 + 1, cj0 - j0:cj1 - j0 + 1, ci0 - i0:ci1 - i0 + 1] > 0
+  axisCounts = [inside.sum(axis=(0, 1), dtype=numpy.int64), inside.sum(axis=(0, 2), dtype=numpy.int64),
+    inside.sum(axis=(1, 2), dtype=numpy.int64)]
+  count = int(axisCounts[0].sum())
+  if not count:
+    return None
+  maskExtent = []
+  coordinateSums = []
+  for counts, first in zip(axisCounts, (ci0, cj0, ck0)):
+    nonzero = numpy.flatnonzero(counts)
+    maskExtent += [first + int(nonzero[0]), first + int(nonzero[-1])]
+    coordinateSums.append(float(numpy.dot(counts, numpy.arange(first, first + len(counts)))))
+  intensitySums = None
+  if grayArray is not None:
+    values = grayArray[ck0:ck1 + 1, cj0:cj1 + 1, ci0:ci1 + 1][inside].astype(numpy.float64)
+    intensitySums = [values.sum(), numpy.dot(values, values), values.min(), values.max()]
+  return count, maskExtent, coordinateSums, intensitySums
+
+def computeLabelStatistics(labelArray, ijkToRas, grayArray=None, labelIndex=None, skipBackground=True):
+  """ Statistics of every label value of a KJI label array, as an ordered dict of column name -> array
+  (STATISTICS_COLUMNS, plus INTENSITY_COLUMNS if grayArray, on the same voxel grid, is given).
+  labelIndex can be passed if already built for labelArray.
+  """
+  return LabelSums.fromArray(labelArray, grayArray, labelIndex).statistics(ijkToRas, skipBackground)
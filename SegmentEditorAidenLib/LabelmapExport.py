@@ -0,0 +1,63 @@
+import time
+import collections
+import numpy
+from .NrrdIO import writeNrrd, spaceFieldsFromIjkToRas
+from .Conversion import smallestLabelType
+
+#
+# Segments -> label array -> labelmap file
+#
+# Segment masks are stored cropped to their own extent; they are pasted into one label array
+# on the reference voxel grid, each with its label value, and the array is written as a NRRD
+# labelmap compressed in parallel chunks.
+#
+
+# Overlap rules, in segment order: a later segment overwrites earlier ones, or only fills unlabeled voxels
+OVERLAP_LAST_WINS = 'last'
+OVERLAP_FIRST_WINS = 'first'
+
+def pasteMask(labelArray, mask, extent, labelValue, overlap=OVERLAP_LAST_WINS):
+  """ Set labelArray to labelValue where the KJI mask (inclusive IJK extent) is nonzero.
+  Voxels that already have a label are overwritten only with OVERLAP_LAST_WINS.
+  Parts of the mask outside labelArray are ignored.
+  Returns (voxels set, voxels that already had a label).
+  """
+  nk, nj, ni = labelArray.shape
+  i0, i1, j0, j1, k0, k1 = extent
+  # overlap of the mask extent with the label array, in label array indices
+  ci0, ci1 = max(i0, 0), min(i1, ni - 1)
+  cj0, cj1 = max(j0, 0), min(j1, nj - 1)
+  ck0, ck1 = max(k0, 0), min(k1, nk - 1)
+  if ci0 > ci1 or cj0 > cj1 or ck0 > ck1:
+    return 0, 0
+  maskRegion = mask[ck0 - k0:ck1 - k0 + 1, cj0 - j0:cj1 - j0 + 1, ci0 - i0:ci1 - i0 + 1] > 0
+  labelRegion = labelArray[ck0:ck1 + 1, cj0:cj1 + 1, ci0:ci1 + 1]
+  labeled = maskRegion & (labelRegion != 0)
+  overlapCount = int(numpy.count_nonzero(labeled))
+  if overlap == OVERLAP_FIRST_WINS and overlapCount:
+    maskRegion &= ~labeled
+  elif overlap not in (OVERLAP_LAST_WINS, OVERLAP_FIRST_WINS):
+    raise ValueError('Unknown overlap rule: {0}'.format(overlap))
+  labelRegion[maskRegion] = labelValue
+  return int(numpy.count_nonzero(maskRegion)), overlapCount
+
+def writeLabelmapFile(filePath, labelArray, ijkToRas, compressionLevel=1, chunkSize=8*1024*1024, workers=None):
+  """ Write a KJI label array as a NRRD labelmap in the smallest integer type that keeps its label values.
+  Data is gzip compressed at compressionLevel (0: raw) in chunks of chunkSize bytes on workers threads.
+  Returns a summary with sizes, time and throughput (MB of voxel data per second).
+  """
+  startTime = time.time()
+  labelArray = labelArray.astype(smallestLabelType(labelArray), copy=False)
+  fields = spaceFieldsFromIjkToRas(ijkToRas)
+  fields['kinds'] = 'domain domain domain'
+  fileBytes = writeNrrd(filePath, labelArray, fields, compressionLevel=compressionLevel, chunkSize=chunkSize,
+    workers=workers)
+  seconds = time.time() - startTime
+  summary = collections.OrderedDict()
+  summary['file'] = filePath
+  summary['rawBytes'] = labelArray.nbytes
+  summary['fileBytes'] = fileBytes
+  summary['seconds'] = seconds
+  summary['megabytesPerSecond'] = labelArray.nbytes / 1.0e6 / max(seconds, 1e-6)
+  summary['compressionRatio'] = labelArray.nbytes / float(max(fileBytes, 1))
+  return summary
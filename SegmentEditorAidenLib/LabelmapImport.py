@@ -0,0 +1,63 @@
+import numpy
+
+#
+# Vectorized labelmap -> segment masks
+#
+# The labelmap is read once: one stable sort groups the flat voxel indices by label value,
+# afterwards every segment mask is written from its own group only, instead of running a
+# full-volume threshold for every label value. Indices are int32 when the volume allows it and
+# group boundaries are read off the sorted values, so the index costs 4 bytes per voxel plus the
+# sorted copy of the labels.
+#
+
+class LabelVoxelGroups(object):
+  """ Voxels of a labelmap array grouped by label value (result of a single sort pass).
+  Voxels of values[n] are the flat indices order[starts[n]:starts[n]+counts[n]].
+  """
+  def __init__(self, labelArray):
+    self.shape = labelArray.shape
+    flat = numpy.ascontiguousarray(labelArray).reshape(-1)
+    self.order = numpy.argsort(flat, kind='stable')
+    if flat.size < 2**31:
+      self.order = self.order.astype(numpy.int32)
+    sortedValues = flat[self.order]
+    # groups start where the sorted value changes, no second sort as in numpy.unique
+    self.starts = numpy.flatnonzero(sortedValues[1:] != sortedValues[:-1]) + 1
+    if flat.size:
+      self.starts = numpy.concatenate(([0], self.starts))
+    self.values = sortedValues[self.starts]
+    self.counts = numpy.diff(numpy.append(self.starts, flat.size))
+    del sortedValues
+    self._positions = dict((int(value), n) for n, value in enumerate(self.values))
+
+  def flatIndices(self, value):
+    """ flat voxel indices of the given label value, empty if the value is absent """
+    n = self._positions.get(int(value))
+    if n is None:
+      return self.order[:0]
+    return self.order[self.starts[n]:self.starts[n] + self.counts[n]]
+
+  def iterCoordinates(self):
+    """ Yield (IJK axis, coordinate of each voxel in order) one axis at a time, so that only one
+    coordinate array is in memory
+    """
+    nk, nj, ni = self.shape
+    yield 0, self.order % ni
+    yield 1, (self.order // ni) % nj
+    yield 2, self.order // (ni * nj)
+
+  def mask(self, value):
+    """ full-size uint8 mask of one label value """
+    mask = numpy.zeros(self.shape, dtype=numpy.uint8)
+    mask.reshape(-1)[self.flatIndices(value)] = 1
+    return mask
+
+def iterLabelMasks(labelArray, labelValues=None):
+  """ Yield (value, mask) for each requested label value, reading labelArray only once.
+  Default label values are 0..max, the same set the threshold loop used to create.
+  """
+  groups = LabelVoxelGroups(labelArray)
+  if labelValues is None:
+    labelValues = range(int(groups.values.max()) + 1) if len(groups.values) else []
+  for value in labelValues:
+    yield value, groups.mask(value)
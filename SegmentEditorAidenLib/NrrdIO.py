@@ -0,0 +1,195 @@
+import os
+import bz2
+import gzip
+import zlib
+import collections
+import concurrent.futures
+import numpy
+
+#
+# Minimal NRRD reader and writer
+#
+# Enough of the NRRD format to read labelmaps and write labelmaps and .seg.nrrd segmentations
+# without Slicer, for batch conversion on machines that only have numpy.
+#
+
+NRRD_TYPES = {
+  'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+  'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+  'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+  'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+  'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+  'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+  'longlong': 'i8', 'long long': 'i8', 'long long int': 'i8', 'signed long long': 'i8', 'signed long long int': 'i8',
+  'int64': 'i8', 'int64_t': 'i8',
+  'ulonglong': 'u8', 'unsigned long long': 'u8', 'unsigned long long int': 'u8', 'uint64': 'u8', 'uint64_t': 'u8',
+  'float': 'f4', 'double': 'f8',
+  }
+NUMPY_TO_NRRD_TYPES = {'i1': 'int8', 'u1': 'uint8', 'i2': 'int16', 'u2': 'uint16', 'i4': 'int32', 'u4': 'uint32',
+  'i8': 'int64', 'u8': 'uint64', 'f4': 'float', 'f8': 'double'}
+
+class NrrdHeader(object):
+  """ Fields and key/value pairs of a NRRD header and where its data starts """
+  def __init__(self, filePath):
+    self.filePath = filePath
+    self.fields = collections.OrderedDict()
+    self.keyValues = collections.OrderedDict()
+    self.dataOffset = 0
+
+  @property
+  def sizes(self):
+    """ axis sizes, fastest axis first """
+    return [int(size) for size in self.fields['sizes'].split()]
+
+  @property
+  def shape(self):
+    """ numpy array shape, slowest axis first (KJI for a 3D volume) """
+    return tuple(reversed(self.sizes))
+
+  @property
+  def dtype(self):
+    dtype = numpy.dtype(NRRD_TYPES[self.fields['type']])
+    if dtype.itemsize > 1:
+      dtype = dtype.newbyteorder('>' if self.fields.get('endian', 'little') == 'big' else '<')
+    return dtype
+
+  @property
+  def encoding(self):
+    return self.fields.get('encoding', 'raw')
+
+  @property
+  def dataFilePath(self):
+    """ file that holds the data, the header file itself for attached data """
+    dataFile = self.fields.get('data file', self.fields.get('datafile'))
+    if dataFile is None:
+      return self.filePath
+    return os.path.join(os.path.dirname(self.filePath), dataFile)
+
+  @property
+  def dataFileOffset(self):
+    if self.dataFilePath == self.filePath:
+      return self.dataOffset
+    return int(self.fields.get('byte skip', 0))
+
+def readNrrdHeader(filePath):
+  header = NrrdHeader(filePath)
+  with open(filePath, 'rb') as nrrdFile:
+    magic = nrrdFile.readline().decode('ascii').strip()
+    if not magic.startswith('NRRD'):
+      raise ValueError('{0} is not a NRRD file'.format(filePath))
+    for line in iter(nrrdFile.readline, b''):
+      line = line.decode('utf-8').rstrip('\r\n')
+      if not line:
+        break
+      if line.startswith('#'):
+        continue
+      if ':=' in line:
+        key, value = line.split(':=', 1)
+        header.keyValues[key] = value
+      else:
+        field, value = line.split(':', 1)
+        header.fields[field.strip().lower()] = value.strip()
+    header.dataOffset = nrrdFile.tell()
+  return header
+
+def readNrrd(filePath):
+  """ Read a NRRD file as (array, header), the array is ordered slowest axis first """
+  header = readNrrdHeader(filePath)
+  count = int(numpy.prod(header.sizes))
+  with open(header.dataFilePath, 'rb') as dataFile:
+    dataFile.seek(header.dataFileOffset)
+    encoding = header.encoding
+    if encoding == 'raw':
+      array = numpy.fromfile(dataFile, dtype=header.dtype, count=count)
+    elif encoding in ('gzip', 'gz'):
+      # GzipFile also reads multi-member streams written by chunked compression
+      with gzip.GzipFile(fileobj=dataFile) as gzipFile:
+        array = numpy.frombuffer(gzipFile.read(count * header.dtype.itemsize), dtype=header.dtype)
+    elif encoding in ('bzip2', 'bz2'):
+      array = numpy.frombuffer(bz2.decompress(dataFile.read()), dtype=header.dtype, count=count)
+    else:
+      raise ValueError('Unsupported NRRD encoding: {0}'.format(encoding))
+  return array.reshape(header.shape), header
+
+def ijkToRasFromNrrdHeader(header):
+  """ 4x4 IJK to RAS matrix from the space fields of a 3D NRRD header """
+  ijkToRas = numpy.eye(4)
+  if 'space directions' in header.fields:
+    directions = [direction for direction in header.fields['space directions'].split() if direction != 'none']
+    for column, direction in enumerate(directions[:3]):
+      ijkToRas[:3, column] = [float(value) for value in direction.strip('()').split(',')]
+  elif 'spacings' in header.fields:
+    spacings = [float(spacing) for spacing in header.fields['spacings'].split() if spacing != 'nan']
+    ijkToRas[:3, :3] = numpy.diag(spacings[:3])
+  if 'space origin' in header.fields:
+    ijkToRas[:3, 3] = [float(value) for value in header.fields['space origin'].strip('()').split(',')]
+  if header.fields.get('space', 'left-posterior-superior') in ('left-posterior-superior', 'LPS'):
+    ijkToRas[:2, :] *= -1
+  return ijkToRas
+
+def spaceFieldsFromIjkToRas(ijkToRas):
+  """ NRRD space fields (LPS, as Slicer writes them) of a 4x4 IJK to RAS matrix """
+  ijkToLps = numpy.array(ijkToRas, dtype=float)
+  ijkToLps[:2, :] *= -1
+  formatVector = lambda vector: '(' + ','.join('{0:.17g}'.format(value) for value in vector) + ')'
+  fields = collections.OrderedDict()
+  fields['space'] = 'left-posterior-superior'
+  fields['space directions'] = ' '.join(formatVector(ijkToLps[:3, column]) for column in range(3))
+  fields['space origin'] = formatVector(ijkToLps[:3, 3])
+  return fields
+
+def iterGzipMembers(data, compressionLevel=6, chunkSize=8*1024*1024, workers=None):
+  """ Compress a bytes-like object as independent gzip members of chunkSize input bytes, in order.
+  Chunks are compressed on a thread pool (zlib releases the GIL); concatenated, the members form
+  one valid gzip stream. At most two chunks per worker are in flight, to bound memory use.
+  """
+  data = memoryview(data).cast('B')
+  def compressMember(start):
+    compressor = zlib.compressobj(compressionLevel, zlib.DEFLATED, 31) # wbits 31: gzip header and trailer
+    return compressor.compress(data[start:start + chunkSize]) + compressor.flush()
+  starts = list(range(0, len(data), chunkSize)) or [0]
+  workers = workers or os.cpu_count() or 1
+  if workers == 1:
+    for start in starts:
+      yield compressMember(start)
+    return
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    pending = collections.deque()
+    for start in starts:
+      pending.append(executor.submit(compressMember, start))
+      if len(pending) >= 2 * workers:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+def writeNrrd(filePath, array, fields=None, keyValues=None, compressionLevel=6, chunkSize=None, workers=1):
+  """ Write an array (slowest axis first) as an attached NRRD file, gzip encoded unless
+  compressionLevel is 0. fields and keyValues are added to the header.
+  If chunkSize (bytes) is set, the data is compressed as independent gzip members on workers threads
+  (all cores if None), see iterGzipMembers. Returns the number of bytes written.
+  """
+  array = numpy.ascontiguousarray(array)
+  dtype = array.dtype.newbyteorder('<') if array.dtype.itemsize > 1 else array.dtype
+  lines = ['NRRD0005', '# Complete NRRD file format specification at:', '# http://teem.sourceforge.net/nrrd/format.html']
+  lines.append('type: ' + NUMPY_TO_NRRD_TYPES[dtype.str[1:]])
+  lines.append('dimension: {0}'.format(array.ndim))
+  lines.append('sizes: ' + ' '.join(str(size) for size in reversed(array.shape)))
+  if dtype.itemsize > 1:
+    lines.append('endian: little')
+  lines.append('encoding: ' + ('gzip' if compressionLevel else 'raw'))
+  for field, value in (fields or {}).items():
+    lines.append('{0}: {1}'.format(field, value))
+  for key, value in (keyValues or {}).items():
+    lines.append('{0}:={1}'.format(key, value))
+  with open(filePath, 'wb') as nrrdFile:
+    nrrdFile.write(('\n'.join(lines) + '\n\n').encode('utf-8'))
+    data = numpy.ascontiguousarray(array.astype(dtype, copy=False)).reshape(-1).view(numpy.uint8)
+    if compressionLevel and chunkSize:
+      for member in iterGzipMembers(data, compressionLevel, chunkSize, workers):
+        nrrdFile.write(member)
+    elif compressionLevel:
+      with gzip.GzipFile(fileobj=nrrdFile, mode='wb', compresslevel=compressionLevel) as gzipFile:
+        gzipFile.write(data)
+    else:
+      nrrdFile.write(data)
+    return nrrdFile.tell()
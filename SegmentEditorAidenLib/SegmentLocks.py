@@ -0,0 +1,152 @@
+import numpy
+
+#
+# Segment locking
+#
+# Locked segments are kept as bit-packed snapshots, and their union as one packed protection mask.
+# Bits are packed along I within each row, so any IJK sub-box can be read or updated without
+# unpacking the whole mask: checking an edited segment only touches its own bounding box.
+#
+
+def _overlap(extent, other):
+  """ Intersection of two inclusive IJK extents, None if empty """
+  overlap = []
+  for axis in range(3):
+    first, last = max(extent[2 * axis], other[2 * axis]), min(extent[2 * axis + 1], other[2 * axis + 1])
+    if first > last:
+      return None
+    overlap += [first, last]
+  return tuple(overlap)
+
+class PackedMask(object):
+  """ Binary mask over an inclusive IJK extent, stored with one bit per voxel """
+  def __init__(self, extent):
+    self.extent = tuple(int(e) for e in extent)
+    i0, i1, j0, j1, k0, k1 = self.extent
+    self.bits = numpy.zeros((k1 - k0 + 1, j1 - j0 + 1, (i1 - i0 + 8) // 8), dtype=numpy.uint8)
+
+  @classmethod
+  def fromMask(cls, mask, extent):
+    """ Pack a KJI mask covering extent """
+    packedMask = cls(extent)
+    packedMask.bits[:] = numpy.packbits(mask > 0, axis=-1)
+    return packedMask
+
+  @property
+  def nbytes(self):
+    return self.bits.nbytes
+
+  def voxelCount(self):
+    return int(numpy.unpackbits(self.bits).sum()) if self.bits.size else 0
+
+  def _region(self, extent):
+    """ (bits slices, first unpacked I index, overlap extent) of the part of extent inside the mask """
+    overlap = _overlap(self.extent, extent)
+    if overlap is None:
+      return None, 0, None
+    i0, i1, j0, j1, k0, k1 = overlap
+    mi0, mj0, mk0 = self.extent[0], self.extent[2], self.extent[4]
+    firstByte, lastByte = (i0 - mi0) // 8, (i1 - mi0) // 8
+    slices = (slice(k0 - mk0, k1 - mk0 + 1), slice(j0 - mj0, j1 - mj0 + 1), slice(firstByte, lastByte + 1))
+    return slices, i0 - mi0 - 8 * firstByte, overlap
+
+  def get(self, extent):
+    """ bool KJI array of the mask over extent, False outside of the mask extent """
+    i0, i1, j0, j1, k0, k1 = extent
+    result = numpy.zeros((k1 - k0 + 1, j1 - j0 + 1, i1 - i0 + 1), dtype=bool)
+    slices, firstBit, overlap = self._region(extent)
+    if overlap is None:
+      return result
+    oi0, oi1, oj0, oj1, ok0, ok1 = overlap
+    unpacked = numpy.unpackbits(self.bits[slices], axis=-1)[..., firstBit:firstBit + oi1 - oi0 + 1]
+    result[ok0 - k0:ok1 - k0 + 1, oj0 - j0:oj1 - j0 + 1, oi0 - i0:oi1 - i0 + 1] = unpacked
+    return result
+
+  def add(self, mask, extent):
+    """ Set the bits of the nonzero voxels of a KJI mask covering extent (parts outside are ignored) """
+    slices, firstBit, overlap = self._region(extent)
+    if overlap is None:
+      return
+    i0, i1, j0, j1, k0, k1 = extent
+    oi0, oi1, oj0, oj1, ok0, ok1 = overlap
+    unpacked = numpy.unpackbits(self.bits[slices], axis=-1)
+    unpacked[..., firstBit:firstBit + oi1 - oi0 + 1] |= (
+      mask[ok0 - k0:ok1 - k0 + 1, oj0 - j0:oj1 - j0 + 1, oi0 - i0:oi1 - i0 + 1] > 0)
+    self.bits[slices] = numpy.packbits(unpacked, axis=-1)
+
+  def toMask(self):
+    """ uint8 KJI mask of the whole extent """
+    return self.get(self.extent).astype(numpy.uint8)
+
+class SegmentLocks(object):
+  """ Locked segments: a packed snapshot (and IJK to RAS matrix) of each, and the packed union of
+  their voxels, the protection mask that edits of other segments may not change.
+  """
+  def __init__(self):
+    self.snapshots = {} # segment ID -> (PackedMask or None if empty, IJK to RAS array)
+    self.protection = None
+
+  def __len__(self):
+    return len(self.snapshots)
+
+  def __contains__(self, segmentId):
+    return segmentId in self.snapshots
+
+  @property
+  def nbytes(self):
+    snapshotBytes = sum(snapshot.nbytes for snapshot, ijkToRas in self.snapshots.values() if snapshot is not None)
+    return snapshotBytes + (self.protection.nbytes if self.protection is not None else 0)
+
+  def lock(self, segmentId, mask, extent, ijkToRas):
+    """ Lock a segment with its current (mask, extent), mask None if it is empty """
+    self.snapshots[segmentId] = (PackedMask.fromMask(mask, extent) if mask is not None else None, ijkToRas)
+    self._updateProtection()
+
+  def unlock(self, segmentId):
+    if self.snapshots.pop(segmentId, None) is not None:
+      self._updateProtection()
+
+  def clear(self):
+    self.snapshots = {}
+    self.protection = None
+
+  def snapshot(self, segmentId):
+    """ (mask, extent, IJK to RAS) of a locked segment, mask and extent None if it was empty """
+    snapshot, ijkToRas = self.snapshots[segmentId]
+    if snapshot is None:
+      return None, None, ijkToRas
+    return snapshot.toMask(), snapshot.extent, ijkToRas
+
+  def changedVoxelCount(self, segmentId, mask, extent):
+    """ Number of voxels where a locked segment differs from its snapshot, mask None if it is empty now """
+    snapshot, ijkToRas = self.snapshots[segmentId]
+    extents = [e for e in (extent, snapshot.extent if snapshot is not None else None) if e is not None]
+    if not extents:
+      return 0
+    unionExtent = []
+    for axis in range(3):
+      unionExtent += [min(e[2 * axis] for e in extents), max(e[2 * axis + 1] for e in extents)]
+    current = PackedMask(unionExtent)
+    if mask is not None:
+      current.add(mask, extent)
+    locked = snapshot.get(unionExtent) if snapshot is not None else False
+    return int(numpy.count_nonzero(current.get(unionExtent) ^ locked))
+
+  def protectedVoxels(self, mask, extent):
+    """ bool array of the nonzero voxels of a KJI mask that are locked """
+    if self.protection is None:
+      return numpy.zeros(mask.shape, dtype=bool)
+    return self.protection.get(extent) & (mask > 0)
+
+  def _updateProtection(self):
+    snapshots = [snapshot for snapshot, ijkToRas in self.snapshots.values() if snapshot is not None]
+    if not snapshots:
+      self.protection = None
+      return
+    extents = numpy.array([snapshot.extent for snapshot in snapshots])
+    unionExtent = []
+    for axis in range(3):
+      unionExtent += [extents[:, 2 * axis].min(), extents[:, 2 * axis + 1].max()]
+    self.protection = PackedMask(unionExtent)
+    for snapshot in snapshots:
+      self.protection.add(snapshot.toMask(), snapshot.extent)
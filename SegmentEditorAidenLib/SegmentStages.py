@@ -0,0 +1,116 @@
+import collections
+import numpy
+from .IncrementalImport import planLabelImport
+from .Conversion import segmentNameForLabel, smallestLabelType
+from .LabelStatistics import LabelSums
+from .LabelmapExport import pasteMask, OVERLAP_LAST_WINS
+
+#
+# Import, statistics and export stages on a segment store
+#
+# The module logic runs these on the segments of a segmentation node (SegmentEditorAiden.SegmentNodeStore),
+# the benchmark on segments kept in memory (Benchmark.MemorySegmentStore), so both run the same code.
+# A segment store holds the segments of one voxel grid and provides:
+#
+#   shape, ijkToRas                      KJI shape and IJK to RAS 4x4 array of the voxel grid
+#   segmentIds()                         segment IDs in segmentation order
+#   addSegment(name)                     ID of a new empty segment
+#   removeSegment(segmentId)
+#   setMask(segmentId, mask, extent)     replace the voxels of a segment by a KJI mask of an inclusive IJK extent
+#   getMask(segmentId)                   (KJI uint8 mask cropped to its voxels, IJK extent), (None, None) if empty
+#   importedSegments()                   label value -> (segment ID, content hash) of imported segments
+#   setImportedLabel(segmentId, labelValue, contentHash, extent)   mark a segment as imported from a label
+#   labelValue(segmentId)                imported label value of a segment, None if it was not imported
+#
+
+def geometryKey(ijkToRas):
+  """ String identifying the voxel grid of a 4x4 IJK to RAS array, part of the segment content hashes """
+  # + 0.0 turns -0.0 (from LPS to RAS sign flips) into 0.0
+  return ','.join('{0:.6g}'.format(ijkToRas[row][column] + 0.0) for row in range(3) for column in range(4))
+
+def planLabelIndexImport(store, labelIndex, geometryKeyString, skipBackground=False):
+  """ Compare the imported segments of store with the labels of labelIndex.
+  Returns (plan, label value -> content hash), see planLabelImport.
+  """
+  contentHashes = dict((labelValue, labelIndex.contentHash(labelValue, geometryKeyString))
+    for labelValue in labelIndex.labelValues(skipBackground=skipBackground))
+  return planLabelImport(store.importedSegments(), contentHashes), contentHashes
+
+def applyLabelIndexImport(store, labelIndex, plan, contentHashes, cropToLabels=True, cropMargin=1):
+  """ Remove, add and rewrite the segments of plan. Segments are cropped to the label bounding box
+  grown by cropMargin voxels if cropToLabels is set.
+  Returns the stored mask bytes of each written segment as an ordered segment ID -> bytes dict.
+  """
+  for segmentId in plan.removed:
+    store.removeSegment(segmentId)
+  storedBytes = collections.OrderedDict()
+  for labelValue, segmentId in [(labelValue, None) for labelValue in plan.added] + plan.changed:
+    if segmentId is None:
+      segmentId = store.addSegment(segmentNameForLabel(labelValue))
+    store.setImportedLabel(segmentId, labelValue, contentHashes[labelValue], labelIndex.extent(labelValue))
+    if cropToLabels:
+      mask, extent = labelIndex.croppedMask(labelValue, cropMargin)
+    else:
+      mask = labelIndex.mask(labelValue)
+      nk, nj, ni = mask.shape
+      extent = (0, ni - 1, 0, nj - 1, 0, nk - 1)
+    store.setMask(segmentId, mask, extent)
+    storedBytes[segmentId] = mask.nbytes
+  return storedBytes
+
+def segmentLabelValues(store, segmentIds=None):
+  """ Label value of each segment as an ordered segment ID -> label value dict.
+  Imported segments keep their original label value, other segments get values above the largest one.
+  """
+  if segmentIds is None:
+    segmentIds = store.segmentIds()
+  return numberSegmentLabelValues(collections.OrderedDict(
+    (segmentId, store.labelValue(segmentId)) for segmentId in segmentIds))
+
+def numberSegmentLabelValues(labelValues):
+  """ Replace the None label values of an ordered segment ID -> imported label value dict (in place)
+  by values above the largest imported one, in segment order. Returns labelValues.
+  """
+  nextLabelValue = max([value for value in labelValues.values() if value is not None] + [0]) + 1
+  for segmentId in labelValues:
+    if labelValues[segmentId] is None:
+      labelValues[segmentId] = nextLabelValue
+      nextLabelValue += 1
+  return labelValues
+
+def segmentStatistics(store, grayArray=None):
+  """ Statistics of every non-empty segment, each measured from its own cropped mask so that
+  overlapping segments count their shared voxels each, with intensity statistics of grayArray
+  (on the voxel grid of store) if given.
+  Returns (statistics, see LabelSums.statistics, segment ID -> label value dict).
+  """
+  labelValues = segmentLabelValues(store)
+  values = []
+  masks = []
+  for segmentId, labelValue in labelValues.items():
+    mask, extent = store.getMask(segmentId)
+    if mask is None:
+      continue
+    values.append(labelValue)
+    masks.append((mask, extent))
+  statistics = LabelSums.fromMasks(values, masks, store.shape, grayArray).statistics(store.ijkToRas,
+    skipBackground=False)
+  return statistics, labelValues
+
+def labelArrayFromStore(store, segmentIds=None, overlap=OVERLAP_LAST_WINS):
+  """ Merge segments into one KJI label array on the voxel grid of store, pasting each segment only
+  within its own extent. Where segments overlap the later segment wins (OVERLAP_LAST_WINS) or the
+  earlier one is kept (OVERLAP_FIRST_WINS), in segmentation order.
+  Returns (label array, segment ID -> label value dict, voxels in more than one segment).
+  """
+  labelValues = segmentLabelValues(store, segmentIds)
+  maximumLabelValue = max(list(labelValues.values()) + [0])
+  labelArray = numpy.zeros(store.shape, dtype=smallestLabelType(numpy.array([maximumLabelValue])))
+  overlapCount = 0
+  for segmentId, labelValue in labelValues.items():
+    mask, extent = store.getMask(segmentId)
+    if mask is None:
+      continue
+    voxelCount, segmentOverlapCount = pasteMask(labelArray, mask, extent, labelValue, overlap)
+    overlapCount += segmentOverlapCount
+  return labelArray, labelValues, overlapCount
@@ -0,0 +1,128 @@
+import bz2
+import gzip
+import hashlib
+import numpy
+from .NrrdIO import readNrrdHeader, ijkToRasFromNrrdHeader
+from .LabelIndex import LabelIndex
+from .LabelStatistics import LabelSums
+
+#
+# Out-of-core labelmap processing
+#
+# Labelmaps larger than memory are read from the NRRD file in slabs of whole K slices: raw data is
+# memory-mapped one slab at a time, compressed data is decompressed sequentially. The label index,
+# statistics and content hashes are reduced slab by slab and cropped segment masks are filled in
+# batches, so peak memory is set by the slab size and the mask budget, not by the volume size.
+#
+
+class NrrdSlabReader(object):
+  """ Reads a 3D NRRD volume as KJI slabs of at most maxSlabBytes (at least one slice) """
+  def __init__(self, filePath, maxSlabBytes=64*1024*1024):
+    self.filePath = filePath
+    self.header = readNrrdHeader(filePath)
+    self.shape = self.header.shape
+    if len(self.shape) != 3:
+      raise ValueError('{0} is not a 3D volume'.format(filePath))
+    self.dtype = self.header.dtype
+    self.sliceBytes = self.shape[1] * self.shape[2] * self.dtype.itemsize
+    self.slabThickness = max(1, min(self.shape[0], maxSlabBytes // self.sliceBytes))
+
+  @property
+  def ijkToRas(self):
+    return ijkToRasFromNrrdHeader(self.header)
+
+  def iterSlabs(self, slabThickness=None):
+    """ Yield (k0, slab) with slab the KJI array of slices k0 .. k0+len(slab)-1 """
+    slabThickness = slabThickness or self.slabThickness
+    nk, nj, ni = self.shape
+    encoding = self.header.encoding
+    if encoding == 'raw':
+      for k0 in range(0, nk, slabThickness):
+        thickness = min(slabThickness, nk - k0)
+        # a new mapping per slab, released when the caller moves on
+        yield k0, numpy.memmap(self.header.dataFilePath, dtype=self.dtype, mode='r',
+          offset=self.header.dataFileOffset + k0 * self.sliceBytes, shape=(thickness, nj, ni))
+      return
+    if encoding in ('gzip', 'gz'):
+      openCompressed = lambda dataFile: gzip.GzipFile(fileobj=dataFile)
+    elif encoding in ('bzip2', 'bz2'):
+      openCompressed = lambda dataFile: bz2.BZ2File(dataFile)
+    else:
+      raise ValueError('Unsupported NRRD encoding: {0}'.format(encoding))
+    with open(self.header.dataFilePath, 'rb') as dataFile:
+      dataFile.seek(self.header.dataFileOffset)
+      with openCompressed(dataFile) as compressedFile:
+        for k0 in range(0, nk, slabThickness):
+          thickness = min(slabThickness, nk - k0)
+          data = compressedFile.read(thickness * self.sliceBytes)
+          if len(data) != thickness * self.sliceBytes:
+            raise ValueError('{0} ends before slice {1}'.format(self.filePath, k0 + len(data) // self.sliceBytes))
+          yield k0, numpy.frombuffer(data, dtype=self.dtype).reshape(thickness, nj, ni)
+
+class LabelmapScan(object):
+  """ Result of one streaming pass over a labelmap: labelIndex (without voxel groups), sums
+  (LabelSums, with intensities if a gray volume was scanned) and contentHashes (label value -> hash,
+  equal to LabelIndex.contentHash of the whole array, if a hash salt was given).
+  """
+  def __init__(self, labelIndex, sums, contentHashes):
+    self.labelIndex = labelIndex
+    self.sums = sums
+    self.contentHashes = contentHashes
+
+def scanLabelmap(labelReader, grayReader=None, hashSalt=None):
+  """ Build the label index, statistics sums and optionally content hashes slab by slab """
+  if grayReader is not None and grayReader.shape != labelReader.shape:
+    raise ValueError('Gray volume shape {0} differs from labelmap shape {1}'.format(grayReader.shape, labelReader.shape))
+  nk, nj, ni = labelReader.shape
+  sliceVoxels = nj * ni
+  graySlabs = grayReader.iterSlabs(labelReader.slabThickness) if grayReader is not None else None
+  sums = None
+  digests = {}
+  for k0, labelSlab in labelReader.iterSlabs():
+    graySlab = next(graySlabs)[1] if graySlabs is not None else None
+    slabIndex = LabelIndex.fromArray(labelSlab)
+    slabSums = LabelSums.fromArray(labelSlab, graySlab, slabIndex, k0)
+    sums = slabSums if sums is None else sums.merge(slabSums)
+    if hashSalt is not None:
+      # voxels are visited in increasing flat index order, as LabelIndex.contentHash hashes them
+      for value in slabIndex.values:
+        digest = digests.get(int(value))
+        if digest is None:
+          digest = digests[int(value)] = hashlib.sha1()
+          digest.update(str(hashSalt).encode('utf-8'))
+          digest.update(numpy.asarray(labelReader.shape, dtype=numpy.int64).tobytes())
+        flatIndices = slabIndex.groups.flatIndices(value).astype(numpy.int64) + k0 * sliceVoxels
+        digest.update(flatIndices.tobytes())
+  labelIndex = LabelIndex(labelReader.shape, sums.values, sums.counts, sums.extents)
+  contentHashes = dict((value, digest.hexdigest()) for value, digest in digests.items()) if hashSalt is not None else None
+  return LabelmapScan(labelIndex, sums, contentHashes)
+
+def iterCroppedMasksFromSlabs(labelReader, labelIndex, labelValues, margin=0, maxMaskBytes=256*1024*1024):
+  """ Yield (value, mask, extent) for each label value like LabelIndex.croppedMask, reading the labelmap
+  slab by slab. Masks of as many labels as fit in maxMaskBytes are filled per pass over the file.
+  """
+  pending = [(value, labelIndex.croppedExtent(value, margin)) for value in labelValues if value in labelIndex]
+  while pending:
+    batch = []
+    batchBytes = 0
+    while pending:
+      value, extent = pending[0]
+      i0, i1, j0, j1, k0, k1 = extent
+      maskBytes = (k1 - k0 + 1) * (j1 - j0 + 1) * (i1 - i0 + 1)
+      if batch and batchBytes + maskBytes > maxMaskBytes:
+        break
+      batch.append((value, extent, numpy.zeros((k1 - k0 + 1, j1 - j0 + 1, i1 - i0 + 1), dtype=numpy.uint8)))
+      batchBytes += maskBytes
+      pending.pop(0)
+    lastSlice = max(extent[5] for value, extent, mask in batch)
+    for slabK0, slab in labelReader.iterSlabs():
+      if slabK0 > lastSlice:
+        break
+      slabK1 = slabK0 + len(slab) - 1
+      for value, (i0, i1, j0, j1, k0, k1), mask in batch:
+        first, last = max(k0, slabK0), min(k1, slabK1)
+        if first > last:
+          continue
+        mask[first - k0:last - k0 + 1] = slab[first - slabK0:last - slabK0 + 1, j0:j1 + 1, i0:i1 + 1] == value
+    for value, extent, mask in batch:
+      yield value, mask, extent
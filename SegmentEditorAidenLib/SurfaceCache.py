@@ -0,0 +1,102 @@
+import os
+import hashlib
+import logging
+import collections
+import numpy
+
+#
+# Content-addressed on-disk cache of generated surfaces
+#
+# Entries are keyed by a hash of the binary mask, its geometry and the conversion parameters and
+# hold the surface arrays of surfaceArraysFromMask in .npz files. Least recently used entries are
+# evicted when the cache grows over its size limit.
+#
+
+class SurfaceCache(object):
+  """ Surfaces stored in a local directory with LRU eviction under maxSizeBytes """
+  fileExtension = '.npz'
+
+  def __init__(self, directory, maxSizeBytes=2*1024*1024*1024):
+    self.directory = directory
+    self.maxSizeBytes = maxSizeBytes
+    self.hits = 0
+    self.misses = 0
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    # key -> file size, least recently used first
+    self._entries = collections.OrderedDict()
+    fileNames = [fileName for fileName in os.listdir(directory) if fileName.endswith(self.fileExtension)]
+    fileStats = [(os.stat(os.path.join(directory, fileName)), fileName) for fileName in fileNames]
+    for fileStat, fileName in sorted(fileStats, key=lambda stat: stat[0].st_mtime):
+      self._entries[fileName[:-len(self.fileExtension)]] = fileStat.st_size
+
+  @staticmethod
+  def key(mask, extent, ijkToRas, smoothingFactor, decimationFactor):
+    """ Cache key of the surface of a KJI mask with inclusive IJK extent """
+    digest = hashlib.sha1()
+    digest.update(numpy.ascontiguousarray(mask, dtype=numpy.uint8).tobytes())
+    digest.update(numpy.asarray(extent, dtype=numpy.int64).tobytes())
+    digest.update(numpy.asarray(ijkToRas, dtype=numpy.float64).round(6).tobytes())
+    digest.update('{0:.6g},{1:.6g}'.format(smoothingFactor, decimationFactor).encode('utf-8'))
+    return digest.hexdigest()
+
+  @property
+  def sizeBytes(self):
+    return sum(self._entries.values())
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key):
+    """ Surface arrays stored under key, None on a miss """
+    if key not in self._entries:
+      self.misses += 1
+      return None
+    filePath = self._filePath(key)
+    try:
+      with numpy.load(filePath) as entry:
+        arrays = dict((name, entry[name]) for name in entry.files)
+      os.utime(filePath, None)
+    except (IOError, OSError, ValueError) as e:
+      logging.warning('Dropping unreadable surface cache entry {0}: {1}'.format(filePath, e))
+      self._remove(key)
+      self.misses += 1
+      return None
+    self._entries.move_to_end(key)
+    self.hits += 1
+    return arrays
+
+  def put(self, key, arrays):
+    """ Store surface arrays under key and evict least recently used entries over the size limit """
+    filePath = self._filePath(key)
+    # write to a temporary file first so that readers never see partial entries
+    temporaryFilePath = filePath + '.tmp'
+    with open(temporaryFilePath, 'wb') as temporaryFile:
+      numpy.savez(temporaryFile, **arrays)
+    os.replace(temporaryFilePath, filePath)
+    self._entries[key] = os.path.getsize(filePath)
+    self._entries.move_to_end(key)
+    self.evict()
+
+  def evict(self):
+    sizeBytes = self.sizeBytes
+    while sizeBytes > self.maxSizeBytes and self._entries:
+      key = next(iter(self._entries))
+      sizeBytes -= self._entries[key]
+      self._remove(key)
+
+  def clear(self):
+    for key in list(self._entries):
+      self._remove(key)
+    self.hits = 0
+    self.misses = 0
+
+  def _filePath(self, key):
+    return os.path.join(self.directory, key + self.fileExtension)
+
+  def _remove(self, key):
+    self._entries.pop(key, None)
+    try:
+      os.remove(self._filePath(key))
+    except OSError:
+      pass
@@ -0,0 +1,211 @@
+import os
+import heapq
+import logging
+import itertools
+import concurrent.futures
+import numpy
+
+#
+# Closed surface generation off the GUI thread
+#
+# Surfaces are computed from cropped binary masks by worker threads or processes and returned as
+# plain numpy arrays (picklable), the GUI thread turns them into vtkPolyData and publishes them.
+#
+
+def cropToNonzero(mask, extent, margin=0):
+  """ Crop a KJI mask with inclusive IJK extent to its nonzero voxels grown by margin.
+  Returns (mask, extent), (None, None) if the mask is empty.
+  """
+  cropped = []
+  # array axes are K, J, I; extent axes are I, J, K
+  for arrayAxis in (2, 1, 0):
+    otherAxes = tuple(axis for axis in range(3) if axis != arrayAxis)
+    nonzero = numpy.flatnonzero(numpy.any(mask, axis=otherAxes))
+    if not len(nonzero):
+      return None, None
+    first = max(nonzero[0] - margin, 0)
+    last = min(nonzero[-1] + margin, mask.shape[arrayAxis] - 1)
+    cropped.append((first, last))
+  (iFirst, iLast), (jFirst, jLast), (kFirst, kLast) = cropped
+  croppedMask = mask[kFirst:kLast + 1, jFirst:jLast + 1, iFirst:iLast + 1]
+  i0, j0, k0 = extent[0], extent[2], extent[4]
+  return croppedMask, (i0 + iFirst, i0 + iLast, j0 + jFirst, j0 + jLast, k0 + kFirst, k0 + kLast)
+
+def surfaceArraysFromMask(mask, extent, ijkToRas, smoothingFactor=0.5, decimationFactor=0.0):
+  """ Closed surface of a KJI binary mask, same pipeline as the Slicer binary labelmap to closed
+  surface conversion (discrete flying edges, decimation, windowed sinc smoothing, normals).
+  The mask is padded by one voxel so that surfaces touching the crop boundary are closed.
+  Returns the surface as arrays, see surfaceArraysFromPolyData.
+  """
+  import vtk
+  from vtk.util import numpy_support
+  padded = numpy.pad((mask > 0).astype(numpy.uint8), 1, mode='constant')
+  nk, nj, ni = padded.shape
+  image = vtk.vtkImageData()
+  image.SetDimensions(ni, nj, nk)
+  image.SetOrigin(extent[0] - 1, extent[2] - 1, extent[4] - 1)
+  image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(padded.reshape(-1), deep=True,
+    array_type=vtk.VTK_UNSIGNED_CHAR))
+
+  contour = vtk.vtkDiscreteFlyingEdges3D() if hasattr(vtk, 'vtkDiscreteFlyingEdges3D') else vtk.vtkDiscreteMarchingCubes()
+  contour.SetInputData(image)
+  contour.GenerateValues(1, 1, 1)
+  contour.ComputeNormalsOff()
+  contour.ComputeGradientsOff()
+  output = contour.GetOutputPort()
+
+  if decimationFactor > 0.0:
+    decimator = vtk.vtkDecimatePro()
+    decimator.SetInputConnection(output)
+    decimator.SetFeatureAngle(60)
+    decimator.SplittingOff()
+    decimator.PreserveTopologyOn()
+    decimator.SetMaximumError(1)
+    decimator.SetTargetReduction(decimationFactor)
+    output = decimator.GetOutputPort()
+
+  if smoothingFactor > 0.0:
+    smoother = vtk.vtkWindowedSincPolyDataFilter()
+    smoother.SetInputConnection(output)
+    smoother.SetNumberOfIterations(20)
+    smoother.FeatureEdgeSmoothingOff()
+    smoother.BoundarySmoothingOff()
+    smoother.NonManifoldSmoothingOn()
+    smoother.NormalizeCoordinatesOn()
+    smoother.SetPassBand(pow(10.0, -4.0 * smoothingFactor))
+    output = smoother.GetOutputPort()
+
+  ijkToRas = numpy.asarray(ijkToRas, dtype=float)
+  transform = vtk.vtkTransform()
+  transform.SetMatrix(ijkToRas.reshape(-1).tolist())
+  transformer = vtk.vtkTransformPolyDataFilter()
+  transformer.SetInputConnection(output)
+  transformer.SetTransform(transform)
+
+  normals = vtk.vtkPolyDataNormals()
+  normals.SetInputConnection(transformer.GetOutputPort())
+  normals.ConsistencyOn()
+  normals.SplittingOff()
+  # Mirroring IJK to RAS matrices turn the surface inside out
+  normals.SetFlipNormals(numpy.linalg.det(ijkToRas[:3, :3]) < 0)
+  normals.Update()
+  return surfaceArraysFromPolyData(normals.GetOutput())
+
+def surfaceArraysFromPolyData(polyData):
+  """ dict of 'points' (n, 3) float32, 'triangles' (m, 3) int64 and optional 'normals' (n, 3) float32.
+  The surface pipeline only produces triangles.
+  """
+  from vtk.util import numpy_support
+  arrays = {
+    'points': numpy.zeros((0, 3), dtype=numpy.float32),
+    'triangles': numpy.zeros((0, 3), dtype=numpy.int64),
+    }
+  if polyData.GetNumberOfPoints():
+    arrays['points'] = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()).astype(numpy.float32)
+  if polyData.GetNumberOfPolys():
+    arrays['triangles'] = numpy_support.vtk_to_numpy(polyData.GetPolys().GetData()).reshape(-1, 4)[:, 1:].astype(numpy.int64)
+  normals = polyData.GetPointData().GetNormals()
+  if normals is not None:
+    arrays['normals'] = numpy_support.vtk_to_numpy(normals).astype(numpy.float32)
+  return arrays
+
+def polyDataFromSurfaceArrays(arrays):
+  """ vtkPolyData from arrays returned by surfaceArraysFromMask """
+  import vtk
+  from vtk.util import numpy_support
+  polyData = vtk.vtkPolyData()
+  points = vtk.vtkPoints()
+  points.SetData(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(arrays['points']), deep=True))
+  polyData.SetPoints(points)
+  triangles = numpy.asarray(arrays['triangles'], dtype=numpy.int64)
+  legacyCells = numpy.hstack([numpy.full((len(triangles), 1), 3, dtype=numpy.int64), triangles])
+  cells = vtk.vtkCellArray()
+  cells.SetCells(len(triangles), numpy_support.numpy_to_vtkIdTypeArray(legacyCells.reshape(-1), deep=True))
+  polyData.SetPolys(cells)
+  if 'normals' in arrays:
+    normals = numpy_support.numpy_to_vtk(numpy.ascontiguousarray(arrays['normals']), deep=True)
+    normals.SetName('Normals')
+    polyData.GetPointData().SetNormals(normals)
+  return polyData
+
+class SurfaceGenerationScheduler(object):
+  """ Computes segment surfaces on a thread or process pool, highest priority first.
+  Only as many jobs as workers are handed to the pool, the rest wait in a priority queue so that
+  prioritize() and cancel() take effect immediately. The owner calls poll() periodically (for example
+  from a QTimer on the GUI thread) to collect finished surfaces; progress callbacks are called
+  with (done, total) whenever surfaces finish.
+  """
+  def __init__(self, maxWorkers=None, useProcesses=False, smoothingFactor=0.5, decimationFactor=0.0):
+    self.maxWorkers = maxWorkers or os.cpu_count() or 1
+    executorClass = concurrent.futures.ProcessPoolExecutor if useProcesses else concurrent.futures.ThreadPoolExecutor
+    self.executor = executorClass(max_workers=self.maxWorkers)
+    self.smoothingFactor = smoothingFactor
+    self.decimationFactor = decimationFactor
+    self.progressCallbacks = []
+    self.total = 0
+    self.done = 0
+    self.failed = 0
+    self.failedKeys = [] # keys of failed jobs, for the owner to fall back on another conversion
+    self._queue = []
+    self._running = {}
+    self._sequence = itertools.count()
+
+  def submit(self, key, mask, extent, ijkToRas, priority=0):
+    """ Queue the surface computation of a mask, higher priority starts earlier """
+    heapq.heappush(self._queue, (-priority, next(self._sequence), key, mask, extent, ijkToRas))
+    self.total += 1
+    self._startJobs()
+
+  def prioritize(self, key):
+    """ Move a queued job in front of all others """
+    for n, job in enumerate(self._queue):
+      if job[2] == key:
+        top = self._queue[0][0] if self._queue else 0
+        self._queue[n] = (min(top, job[0]) - 1,) + job[1:]
+        heapq.heapify(self._queue)
+        return True
+    return False
+
+  @property
+  def isFinished(self):
+    return not self._queue and not self._running
+
+  def poll(self):
+    """ Collect finished surfaces as a list of (key, surface arrays) and start queued jobs """
+    finished = []
+    for future in [future for future in self._running if future.done()]:
+      key = self._running.pop(future)
+      if future.cancelled():
+        continue
+      try:
+        finished.append((key, future.result()))
+      except Exception as e:
+        logging.error('Surface generation failed for {0}: {1}'.format(key, e))
+        self.failed += 1
+        self.failedKeys.append(key)
+      self.done += 1
+    self._startJobs()
+    if finished:
+      for callback in self.progressCallbacks:
+        callback(self.done, self.total)
+    return finished
+
+  def cancel(self):
+    """ Drop queued jobs and discard results of running ones """
+    self.total -= len(self._queue)
+    self._queue = []
+    for future in self._running:
+      future.cancel()
+    self.total -= len(self._running)
+    self._running = {}
+
+  def shutdown(self):
+    self.cancel()
+    self.executor.shutdown(wait=False)
+
+  def _startJobs(self):
+    while self._queue and len(self._running) < self.maxWorkers:
+      priority, sequence, key, mask, extent, ijkToRas = heapq.heappop(self._queue)
+      future = self.executor.submit(surfaceArraysFromMask, mask, extent, ijkToRas, self.smoothingFactor,
+        self.decimationFactor)
+      self._running[future] = key
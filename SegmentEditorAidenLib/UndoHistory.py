@@ -0,0 +1,238 @@
+import numpy
+from .SegmentLocks import PackedMask
+from .SurfaceGeneration import cropToNonzero
+
+#
+# Delta-compressed undo history
+#
+# Instead of a full copy of the segmentation per undo state, each step stores only the voxels that
+# changed in each modified segment: the XOR of the segment before and after, over the union of both
+# bounding boxes, run-length encoded. XOR diffs apply in both directions, so one diff serves undo and
+# redo. The current state of every segment is cached bit-packed to compute the next diff. Segment tags
+# and positions before and after are kept with each change, so that undo restores them with the voxels.
+# Steps are dropped oldest first to stay within a memory budget.
+#
+
+def encodeRuns(flatMask):
+  """ (starts, lengths) of the runs of nonzero values of a 1D mask """
+  padded = numpy.concatenate(([0], numpy.asarray(flatMask, dtype=numpy.int8), [0]))
+  edges = numpy.flatnonzero(numpy.diff(padded))
+  dtype = numpy.int32 if len(padded) < 2**31 else numpy.int64
+  starts = edges[0::2].astype(dtype)
+  return starts, (edges[1::2] - edges[0::2]).astype(dtype)
+
+def decodeRuns(starts, lengths, size):
+  """ bool 1D mask of the given size from (starts, lengths) of its runs """
+  delta = numpy.zeros(size + 1, dtype=numpy.int8)
+  # runs are maximal, so no run ends where another starts and the updates do not collide
+  delta[starts] += 1
+  delta[starts.astype(numpy.int64) + lengths] -= 1
+  return numpy.cumsum(delta[:-1], dtype=numpy.int8).astype(bool)
+
+class SegmentState(object):
+  """ Voxels (PackedMask, None if empty), IJK to RAS array, name, color, tags (tag name -> value dict)
+  and index in the segmentation of a segment. Tags and index are None if not recorded.
+  """
+  def __init__(self, packedMask, ijkToRas, name, color, tags=None, index=None):
+    self.packedMask = packedMask
+    self.ijkToRas = ijkToRas
+    self.name = name
+    self.color = color
+    self.tags = tags
+    self.index = index
+
+  @classmethod
+  def fromMask(cls, mask, extent, ijkToRas, name, color, tags=None, index=None):
+    return cls(PackedMask.fromMask(mask, extent) if mask is not None else None, ijkToRas, name, color, tags, index)
+
+  @property
+  def extent(self):
+    return self.packedMask.extent if self.packedMask is not None else None
+
+  @property
+  def nbytes(self):
+    return self.packedMask.nbytes if self.packedMask is not None else 0
+
+  def voxels(self, extent):
+    """ bool KJI array of the segment over extent """
+    if self.packedMask is None:
+      i0, i1, j0, j1, k0, k1 = extent
+      return numpy.zeros((k1 - k0 + 1, j1 - j0 + 1, i1 - i0 + 1), dtype=bool)
+    return self.packedMask.get(extent)
+
+  def mask(self):
+    """ (uint8 KJI mask, extent), (None, None) if the segment is empty """
+    if self.packedMask is None:
+      return None, None
+    return self.packedMask.toMask(), self.packedMask.extent
+
+class SegmentChange(object):
+  """ Changed voxels of one segment in one step, whether the segment existed before and after, and its
+  tags and index before and after
+  """
+  def __init__(self, segmentId, extent, runs, existedBefore, existsAfter, name, color, ijkToRas,
+      tagsBefore=None, tagsAfter=None, indexBefore=None, indexAfter=None):
+    self.segmentId = segmentId
+    self.extent = extent
+    self.runs = runs
+    self.existedBefore = existedBefore
+    self.existsAfter = existsAfter
+    self.name = name
+    self.color = color
+    self.ijkToRas = ijkToRas
+    self.tagsBefore = tagsBefore
+    self.tagsAfter = tagsAfter
+    self.indexBefore = indexBefore
+    self.indexAfter = indexAfter
+
+  @property
+  def nbytes(self):
+    return sum(run.nbytes for run in self.runs) if self.runs else 0
+
+def _unionExtent(extents):
+  extents = [extent for extent in extents if extent is not None]
+  if not extents:
+    return None
+  unionExtent = []
+  for axis in range(3):
+    unionExtent += [min(extent[2 * axis] for extent in extents), max(extent[2 * axis + 1] for extent in extents)]
+  return tuple(int(e) for e in unionExtent)
+
+def _extentSize(extent):
+  i0, i1, j0, j1, k0, k1 = extent
+  return (k1 - k0 + 1) * (j1 - j0 + 1) * (i1 - i0 + 1)
+
+class UndoHistory(object):
+  """ Undo/redo steps of segment voxel changes as run-length encoded XOR diffs, within maxBytes """
+  def __init__(self, maxBytes=256*1024*1024):
+    self.maxBytes = maxBytes
+    self.states = {} # segment ID -> SegmentState, the current content
+    self.undoStack = [] # steps, each a list of SegmentChange
+    self.redoStack = []
+
+  def reset(self, states=None):
+    """ Forget all steps, states is the new segment ID -> SegmentState content """
+    self.states = dict(states or {})
+    self.undoStack = []
+    self.redoStack = []
+
+  @property
+  def nbytes(self):
+    """ memory of the undo and redo steps """
+    return sum(change.nbytes for step in self.undoStack + self.redoStack for change in step)
+
+  @property
+  def cacheBytes(self):
+    """ memory of the packed current state """
+    return sum(state.nbytes for state in self.states.values())
+
+  def setMaxBytes(self, maxBytes):
+    self.maxBytes = maxBytes
+    self._evict()
+
+  def canUndo(self):
+    return bool(self.undoStack)
+
+  def canRedo(self):
+    return bool(self.redoStack)
+
+  def record(self, newStates):
+    """ Record one step from segment ID -> new SegmentState (None for removed segments) of the
+    modified segments. Returns the IDs of the segments that changed (empty if none did).
+    """
+    step = []
+    for segmentId, newState in newStates.items():
+      oldState = self.states.get(segmentId)
+      if oldState is None and newState is None:
+        continue
+      extent = _unionExtent([oldState.extent if oldState else None, newState.extent if newState else None])
+      runs = None
+      if extent is not None:
+        oldVoxels = oldState.voxels(extent) if oldState else False
+        newVoxels = newState.voxels(extent) if newState else False
+        changed = numpy.logical_xor(oldVoxels, newVoxels).reshape(-1)
+        if changed.any():
+          runs = encodeRuns(changed)
+      existenceChanged = (oldState is None) != (newState is None)
+      if runs is None and not existenceChanged:
+        if newState is not None:
+          self.states[segmentId] = newState
+        continue
+      properties = newState or oldState
+      step.append(SegmentChange(segmentId, extent, runs, oldState is not None, newState is not None,
+        properties.name, properties.color, properties.ijkToRas,
+        oldState.tags if oldState else None, newState.tags if newState else None,
+        oldState.index if oldState else None, newState.index if newState else None))
+      if newState is None:
+        del self.states[segmentId]
+      else:
+        self.states[segmentId] = newState
+    if not step:
+      return []
+    self.undoStack.append(step)
+    self.redoStack = []
+    self._evict()
+    return [change.segmentId for change in step]
+
+  def amendTags(self, segmentId, tags):
+    """ Replace the tags of a segment in its current state and in the last step, for tags changed
+    because of that step (for example import tags of edited segments)
+    """
+    state = self.states.get(segmentId)
+    if state is not None:
+      state.tags = tags
+    for change in self.undoStack[-1] if self.undoStack else []:
+      if change.segmentId == segmentId:
+        change.tagsAfter = tags
+
+  def undo(self):
+    """ Revert the last step, returns segment ID -> SegmentState (None: remove the segment) to apply """
+    if not self.undoStack:
+      return {}
+    step = self.undoStack.pop()
+    self.redoStack.append(step)
+    return self._apply(reversed(step), undo=True)
+
+  def redo(self):
+    """ Repeat the last undone step, see undo """
+    if not self.redoStack:
+      return {}
+    step = self.redoStack.pop()
+    self.undoStack.append(step)
+    return self._apply(step, undo=False)
+
+  def _apply(self, changes, undo):
+    appliedStates = {}
+    for change in changes:
+      exists = change.existedBefore if undo else change.existsAfter
+      if not exists:
+        self.states.pop(change.segmentId, None)
+        appliedStates[change.segmentId] = None
+        continue
+      state = self.states.get(change.segmentId) or SegmentState(None, change.ijkToRas, change.name, change.color)
+      tags = change.tagsBefore if undo else change.tagsAfter
+      index = change.indexBefore if undo else change.indexAfter
+      state = SegmentState(state.packedMask, state.ijkToRas, state.name, state.color, tags, index)
+      if change.runs is not None:
+        voxels = state.voxels(change.extent)
+        voxels ^= decodeRuns(change.runs[0], change.runs[1], _extentSize(change.extent)).reshape(voxels.shape)
+        # voxels of the segment outside of the diff extent are unchanged
+        if state.extent is not None:
+          unionExtent = _unionExtent([state.extent, change.extent])
+          allVoxels = state.voxels(unionExtent)
+          i0, i1, j0, j1, k0, k1 = change.extent
+          allVoxels[k0 - unionExtent[4]:k1 - unionExtent[4] + 1, j0 - unionExtent[2]:j1 - unionExtent[2] + 1,
+            i0 - unionExtent[0]:i1 - unionExtent[0] + 1] = voxels
+          voxels, extent = allVoxels, unionExtent
+        else:
+          extent = change.extent
+        mask, extent = cropToNonzero(voxels, extent)
+        state = SegmentState.fromMask(mask, extent, state.ijkToRas, state.name, state.color, tags, index)
+      self.states[change.segmentId] = state
+      appliedStates[change.segmentId] = state
+    return appliedStates
+
+  def _evict(self):
+    """ Drop the oldest steps until the history fits in maxBytes, the newest step is always kept """
+    while len(self.undoStack) > 1 and self.nbytes > self.maxBytes:
+      self.undoStack.pop(0)
@@ -0,0 +1,34 @@
+import numpy
+
+#
+# Camera fit from segment bounds
+#
+# Bounds are derived from the label bounding boxes at import time, so the 3D view can be framed
+# before any closed surface exists.
+#
+
+def rasBoundsFromExtent(extent, ijkToRas):
+  """ RAS bounds (xMin, xMax, yMin, yMax, zMin, zMax) of the voxels of an inclusive IJK extent.
+  ijkToRas is a 4x4 array, voxel faces (index +/- 0.5) are included.
+  """
+  i0, i1, j0, j1, k0, k1 = extent
+  corners = numpy.array([[i, j, k, 1.0] for i in (i0 - 0.5, i1 + 0.5) for j in (j0 - 0.5, j1 + 0.5)
+    for k in (k0 - 0.5, k1 + 0.5)])
+  ras = numpy.dot(corners, numpy.asarray(ijkToRas, dtype=float).T)[:, :3]
+  minima = ras.min(axis=0)
+  maxima = ras.max(axis=0)
+  return (minima[0], maxima[0], minima[1], maxima[1], minima[2], maxima[2])
+
+def unionBounds(boundsList):
+  """ Bounds enclosing all given bounds, None if the list is empty """
+  boundsArray = numpy.asarray(list(boundsList), dtype=float).reshape(-1, 6)
+  if not len(boundsArray):
+    return None
+  return (boundsArray[:, 0].min(), boundsArray[:, 1].max(), boundsArray[:, 2].min(), boundsArray[:, 3].max(),
+    boundsArray[:, 4].min(), boundsArray[:, 5].max())
+
+def boundsToString(bounds):
+  return ','.join('{0:.6g}'.format(b) for b in bounds)
+
+def boundsFromString(boundsString):
+  return tuple(float(b) for b in boundsString.split(','))
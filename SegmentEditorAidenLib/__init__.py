@@ -0,0 +1,15 @@
+from .LabelmapImport import *
+from .LabelIndex import *
+from .IncrementalImport import *
+from .ViewFit import *
+from .SurfaceGeneration import *
+from .SurfaceCache import *
+from .NrrdIO import *
+from .Conversion import *
+from .IntensityRanges import *
+from .LabelStatistics import *
+from .LabelmapExport import *
+from .Streaming import *
+from .SegmentLocks import *
+from .UndoHistory import *
+from .SegmentStages import *